@@ -0,0 +1,312 @@
+import asyncio
+import itertools
+import random
+import time
+import uuid
+from typing import Optional, Dict, List, Tuple
+
+from aiohttp import web
+
+PREFIX = "/_matrix/client/r0"
+MEDIA_PREFIX = "/_matrix/media/r0"
+
+
+class FakeRoom:
+    def __init__(self, room_id: str, creator: str, server: str):
+        self.id = room_id
+        self.state: Dict[Tuple[str, str], dict] = {}
+        self.aliases: List[str] = [f"#{room_id[1:].split(':')[0]}:{server}"]
+        self.receipts: Dict[str, str] = {}
+        self.creator = creator
+
+
+class FakeHomeserver:
+    def __init__(
+        self,
+        server_name: str = "fake.local",
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after_ms: int = 100,
+        seed: int = 0,
+        timeline_limit: int = 10,
+    ):
+        self.server_name = server_name
+        # Recent timeline events per room in the initial sync
+        self.timeline_limit = timeline_limit
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.rooms: Dict[str, FakeRoom] = {}
+        self.stream: List[Tuple[int, str, dict]] = []
+        self.position = 0
+        self.changed = asyncio.Condition()
+        self.tokens: Dict[str, str] = {}
+        self.transactions: Dict[Tuple[str, str], str] = {}
+        self.media: Dict[str, Tuple[str, bytes]] = {}
+        self.counts: Dict[str, int] = {
+            "requests": 0, "errors": 0, "rate_limited": 0, "sent": 0, "receipts": 0, "uploads": 0, "downloads": 0
+        }
+        self.runner: Optional[web.AppRunner] = None
+        self.base_url: Optional[str] = None
+        self.app = web.Application(middlewares=[self.middleware])
+        self.app.add_routes([
+            web.post(f"{PREFIX}/login", self.login),
+            web.post(f"{PREFIX}/logout", self.logout),
+            web.post(f"{PREFIX}/user/{{user_id}}/filter", self.create_filter),
+            web.get(f"{PREFIX}/sync", self.sync),
+            web.get(f"{PREFIX}/joined_rooms", self.joined_rooms),
+            web.put(f"{PREFIX}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}", self.send),
+            web.put(f"{PREFIX}/rooms/{{room_id}}/state/{{event_type}}/{{state_key:.*}}", self.send_state),
+            web.post(f"{PREFIX}/rooms/{{room_id}}/receipt/{{receipt_type}}/{{event_id}}", self.receipt),
+            web.get(f"{PREFIX}/rooms/{{room_id}}/state", self.get_state),
+            web.get(f"{PREFIX}/rooms/{{room_id}}/joined_members", self.joined_members),
+            web.get(f"{PREFIX}/rooms/{{room_id}}/messages", self.messages),
+            web.get(f"{PREFIX}/directory/room/{{alias}}", self.directory),
+            web.post(f"{MEDIA_PREFIX}/upload", self.upload),
+            web.get(f"{MEDIA_PREFIX}/download/{{server_name}}/{{media_id}}", self.download),
+            web.get(f"{MEDIA_PREFIX}/thumbnail/{{server_name}}/{{media_id}}", self.download),
+        ])
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        self.counts["requests"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not request.path.endswith("/login"):
+            if request.headers.get("Authorization", "")[7:] not in self.tokens:
+                return web.json_response({"errcode": "M_UNKNOWN_TOKEN", "error": "Unknown token"}, status=401)
+            if self.rate_limit_rate and self.random.random() < self.rate_limit_rate:
+                self.counts["rate_limited"] += 1
+                return web.json_response(
+                    {"errcode": "M_LIMIT_EXCEEDED", "error": "Too many requests", "retry_after_ms": self.retry_after_ms},
+                    status=429,
+                )
+            # Errors are only injected into writes so the sync loop keeps running
+            if request.method != "GET" and self.error_rate and self.random.random() < self.error_rate:
+                self.counts["errors"] += 1
+                return web.json_response({"errcode": "M_UNKNOWN", "error": "Injected error"}, status=500)
+        return await handler(request)
+
+    def _user(self, request: web.Request) -> str:
+        return self.tokens[request.headers["Authorization"][7:]]
+
+    def _room(self, request: web.Request) -> FakeRoom:
+        room = self.rooms.get(request.match_info["room_id"])
+        if room is None:
+            raise web.HTTPForbidden(
+                text='{"errcode": "M_FORBIDDEN", "error": "Not in room"}', content_type="application/json"
+            )
+        return room
+
+    def create_room(self, room_id: Optional[str] = None, members: int = 5, creator: str = None) -> FakeRoom:
+        room_id = room_id or f"!{uuid.uuid4().hex[:12]}:{self.server_name}"
+        creator = creator or f"@admin:{self.server_name}"
+        room = self.rooms[room_id] = FakeRoom(room_id, creator, self.server_name)
+        self.add_event(room_id, "m.room.create", {"creator": creator, "room_version": "6"}, creator, state_key="")
+        self.add_event(room_id, "m.room.name", {"name": f"Room {len(self.rooms)}"}, creator, state_key="")
+        self.add_event(room_id, "m.room.canonical_alias", {"alias": room.aliases[0]}, creator, state_key="")
+        for n in range(members):
+            user = f"@user{n}:{self.server_name}"
+            self.add_event(room_id, "m.room.member", {"membership": "join", "displayname": f"User {n}"}, user, state_key=user)
+        return room
+
+    def add_event(self, room_id: str, event_type: str, content: dict, sender: str, state_key: Optional[str] = None) -> str:
+        self.position += 1
+        event = {
+            "type": event_type,
+            "content": content,
+            "sender": sender,
+            "event_id": f"${self.position}:{self.server_name}",
+            "origin_server_ts": int(time.time() * 1000),
+            "unsigned": {"age": 0},
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+            self.rooms[room_id].state[(event_type, state_key)] = event
+        self.stream.append((self.position, room_id, event))
+        return event["event_id"]
+
+    async def inject(self, room_id: str, event_type: str, content: dict, sender: str, state_key: Optional[str] = None) -> str:
+        event_id = self.add_event(room_id, event_type, content, sender, state_key)
+        async with self.changed:
+            self.changed.notify_all()
+        return event_id
+
+    async def script(self, rate: float, duration: float, body: str = "!ping", sender: str = None):
+        # Writes messages round robin into every room at the given rate
+        sender = sender or f"@user0:{self.server_name}"
+        rooms = itertools.cycle(list(self.rooms))
+        interval = 1 / rate
+        end = time.monotonic() + duration
+        next_at = time.monotonic()
+        while time.monotonic() < end:
+            await self.inject(next(rooms), "m.room.message", {"msgtype": "m.text", "body": body}, sender)
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+
+    async def login(self, request: web.Request):
+        data = await request.json()
+        user = data.get("identifier", {}).get("user") or f"@bot:{self.server_name}"
+        if not user.startswith("@"):
+            user = f"@{user}:{self.server_name}"
+        token = uuid.uuid4().hex
+        self.tokens[token] = user
+        for room_id in self.rooms:
+            if ("m.room.member", user) not in self.rooms[room_id].state:
+                self.add_event(room_id, "m.room.member", {"membership": "join"}, user, state_key=user)
+        return web.json_response({"access_token": token, "device_id": data.get("device_id", "FAKE"), "user_id": user})
+
+    async def logout(self, request: web.Request):
+        self.tokens.pop(request.headers["Authorization"][7:], None)
+        return web.json_response({})
+
+    async def create_filter(self, request: web.Request):
+        return web.json_response({"filter_id": str(len(self.tokens))})
+
+    async def joined_rooms(self, request: web.Request):
+        return web.json_response({"joined_rooms": list(self.rooms)})
+
+    async def sync(self, request: web.Request):
+        since = request.query.get("since")
+        timeout = int(request.query.get("timeout", "0")) / 1000
+        if since is None:
+            return web.json_response(self._initial_sync())
+
+        since = int(since[1:])
+        if self.position <= since and timeout:
+            async with self.changed:
+                try:
+                    await asyncio.wait_for(self.changed.wait_for(lambda: self.position > since), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        join = {}
+        # Positions start at 1 and are contiguous, so everything after since starts at that index
+        for position, room_id, event in self.stream[since:]:
+            room = join.setdefault(room_id, self._room_block([], [], f"t{since + 1}"))
+            room["timeline"]["events"].append(event)
+        return web.json_response(self._sync_body(join))
+
+    def _initial_sync(self) -> dict:
+        join = {
+            room_id: self._room_block(list(room.state.values()), [], f"t{self.position + 1}")
+            for room_id, room in self.rooms.items()
+        }
+        # Like a real server the newest messages of every room come with it, state is already in the state block
+        for position, room_id, event in reversed(self.stream):
+            if "state_key" in event:
+                continue
+            timeline = join[room_id]["timeline"]
+            if len(timeline["events"]) >= self.timeline_limit:
+                timeline["limited"] = True
+                continue
+            timeline["events"].insert(0, event)
+            timeline["prev_batch"] = f"t{position}"
+        return self._sync_body(join)
+
+    @staticmethod
+    def _room_block(state: List[dict], timeline: List[dict], prev_batch: str) -> dict:
+        return {
+            "state": {"events": state},
+            "timeline": {"events": timeline, "limited": False, "prev_batch": prev_batch},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+        }
+
+    def _sync_body(self, join: dict) -> dict:
+        return {
+            "next_batch": f"s{self.position}",
+            "presence": {"events": []},
+            "rooms": {"join": join, "invite": {}, "leave": {}},
+        }
+
+    async def send(self, request: web.Request):
+        room = self._room(request)
+        user = self._user(request)
+        key = (user, request.match_info["txn_id"])
+        if key not in self.transactions:
+            content = await request.json()
+            self.transactions[key] = await self.inject(room.id, request.match_info["event_type"], content, user)
+            self.counts["sent"] += 1
+        return web.json_response({"event_id": self.transactions[key]})
+
+    async def send_state(self, request: web.Request):
+        room = self._room(request)
+        content = await request.json()
+        event_id = await self.inject(
+            room.id, request.match_info["event_type"], content, self._user(request), request.match_info["state_key"]
+        )
+        return web.json_response({"event_id": event_id})
+
+    async def receipt(self, request: web.Request):
+        room = self._room(request)
+        room.receipts[self._user(request)] = request.match_info["event_id"]
+        self.counts["receipts"] += 1
+        return web.json_response({})
+
+    async def get_state(self, request: web.Request):
+        return web.json_response(list(self._room(request).state.values()))
+
+    async def joined_members(self, request: web.Request):
+        room = self._room(request)
+        joined = {
+            state_key: {"display_name": event["content"].get("displayname"), "avatar_url": None}
+            for (event_type, state_key), event in room.state.items()
+            if event_type == "m.room.member" and event["content"].get("membership") == "join"
+        }
+        return web.json_response({"joined": joined})
+
+    async def directory(self, request: web.Request):
+        alias = request.match_info["alias"]
+        for room in self.rooms.values():
+            if alias in room.aliases:
+                return web.json_response({"room_id": room.id, "servers": [self.server_name]})
+        return web.json_response({"errcode": "M_NOT_FOUND", "error": "Room alias not found"}, status=404)
+
+    async def upload(self, request: web.Request):
+        body = bytearray()
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            body.extend(chunk)
+        media_id = uuid.uuid4().hex
+        self.media[media_id] = (request.content_type, bytes(body))
+        self.counts["uploads"] += 1
+        return web.json_response({"content_uri": f"mxc://{self.server_name}/{media_id}"})
+
+    async def download(self, request: web.Request):
+        media = self.media.get(request.match_info["media_id"])
+        if media is None or request.match_info["server_name"] != self.server_name:
+            return web.json_response({"errcode": "M_NOT_FOUND", "error": "Not found"}, status=404)
+        self.counts["downloads"] += 1
+        return web.Response(body=media[1], content_type=media[0])
+
+    async def messages(self, request: web.Request):
+        room = self._room(request)
+        limit = int(request.query.get("limit", "10"))
+        forwards = request.query.get("dir", "b") == "f"
+        token = request.query.get("from")
+        start = int(token[1:]) if token else (1 if forwards else self.position + 1)
+        # Tokens are stream positions, backwards pages hold the events before it and forwards pages from it on
+        if forwards:
+            events = [(p, e) for p, room_id, e in self.stream[start - 1:] if room_id == room.id][:limit]
+        else:
+            events = [(p, e) for p, room_id, e in reversed(self.stream[:start - 1]) if room_id == room.id][:limit]
+        body = {"chunk": [event for _, event in events], "start": f"t{start}"}
+        if events:
+            body["end"] = f"t{events[-1][0] + 1}" if forwards else f"t{events[-1][0]}"
+        return web.json_response(body)
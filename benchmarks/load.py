@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List
+
+from morpheus.core.api import APIConfig
+from morpheus.core.client import Client
+from morpheus.exts.bot import Bot
+
+from .homeserver import FakeHomeserver
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_load(args) -> dict:
+    server = FakeHomeserver(
+        latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit, seed=args.seed
+    )
+    for _ in range(args.rooms):
+        server.create_room(members=args.members)
+    base_url = await server.start()
+
+    bot = Bot("!", homeserver=base_url)
+    bot.loop = asyncio.get_running_loop()
+    bot.sync_timeout = 1000
+    bot.api_config = APIConfig(max_retry=3)
+    bot.sync_pipeline_depth = args.pipeline_depth
+    if args.profile:
+        bot.enable_profiling()
+    latencies: List[float] = []
+    received = asyncio.Event()
+
+    @bot.command(name="ping")
+    async def ping(ctx):
+        # origin_server_ts is set by the fake server when the message is injected
+        latencies.append(time.time() * 1000 - ctx.event.origin_server_ts)
+        if len(latencies) >= args.messages:
+            received.set()
+
+    bot.register_handler("m.room.message", bot.process_command)
+    # Bot.run blocks on its own loop, the coroutine underneath it is driven here instead
+    client_task = asyncio.ensure_future(Client.run(bot, "@bot:fake.local", password="password"))
+    # Messages are only scripted once the first sync has been processed, so none of them can be missed
+    while bot.sync_since is None:
+        await asyncio.sleep(0.01)
+        if client_task.done():
+            client_task.result()
+
+    script = asyncio.ensure_future(server.script(args.rate, args.messages / args.rate))
+    try:
+        await asyncio.wait_for(received.wait(), args.messages / args.rate + args.grace)
+    except asyncio.TimeoutError:
+        pass
+    await script
+
+    sent_before = server.counts["sent"]
+    start = time.perf_counter()
+    errors = 0
+    async for room, result in bot.send_many(
+        [room_id for room_id in server.rooms for _ in range(args.sends // len(server.rooms) or 1)],
+        {"msgtype": "m.notice", "body": "load"},
+        concurrency=args.concurrency,
+    ):
+        if isinstance(result, Exception) or result.get("errcode"):
+            errors += 1
+    send_seconds = time.perf_counter() - start
+    sent = server.counts["sent"] - sent_before
+
+    bot.running = False
+    await client_task
+    await bot.api.close()
+    await server.stop()
+
+    return {
+        "handled": len(latencies),
+        "latency_ms": {
+            "mean": statistics.fmean(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+        "sends": sent,
+        "send_errors": errors,
+        "sends_per_sec": sent / send_seconds if send_seconds else 0.0,
+        "server": dict(server.counts),
+        "profile": bot.profiler.report() if bot.profiler else None,
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Load test a Bot against a local fake homeserver")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--members", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=500, help="scripted messages to deliver to the bot")
+    parser.add_argument("--rate", type=float, default=200.0, help="scripted messages per second")
+    parser.add_argument("--sends", type=int, default=500, help="messages the bot sends with send_many")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of writes that fail with a 500")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--grace", type=float, default=5.0, help="seconds to wait for the last messages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pipeline-depth", type=int, default=1, help="sync batches in flight at once")
+    parser.add_argument("--profile", action="store_true", help="print the slowest handlers and commands")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_load(args))
+    latency = result["latency_ms"]
+    print(f"handled     {result['handled']} messages")
+    print(f"latency ms  mean {latency['mean']:.1f} p50 {latency['p50']:.1f} p95 {latency['p95']:.1f} p99 {latency['p99']:.1f}")
+    print(f"sends       {result['sends']} ok, {result['send_errors']} failed, {result['sends_per_sec']:.0f}/s")
+    print(f"server      {result['server']}")
+    if result["profile"]:
+        print(result["profile"])
+
+
+if __name__ == "__main__":
+    main()
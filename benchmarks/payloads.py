@@ -0,0 +1,124 @@
+import random
+from typing import Dict, Optional
+
+MESSAGE_MIX = {
+    "m.text": 0.8,
+    "m.notice": 0.1,
+    "m.image": 0.05,
+    "m.file": 0.05,
+}
+
+STATE_TYPES = (
+    "m.room.name",
+    "m.room.topic",
+    "m.room.member",
+    "m.room.power_levels",
+    "m.room.canonical_alias",
+)
+
+
+class PayloadGenerator:
+    def __init__(self, seed: int = 0, server: str = "bench.local"):
+        self.random = random.Random(seed)
+        self.server = server
+        self.counter = 0
+        self.ts = 1_600_000_000_000
+
+    def _event_id(self) -> str:
+        self.counter += 1
+        return f"${self.counter}:{self.server}"
+
+    def _user(self, users: int) -> str:
+        return f"@user{self.random.randrange(users)}:{self.server}"
+
+    def _envelope(self, event_type: str, content: dict, sender: str, state_key: Optional[str] = None) -> dict:
+        self.ts += self.random.randrange(1, 1000)
+        event = {
+            "type": event_type,
+            "content": content,
+            "sender": sender,
+            "event_id": self._event_id(),
+            "origin_server_ts": self.ts,
+            "unsigned": {"age": self.random.randrange(10000)},
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+        return event
+
+    def message(self, msgtype: str, sender: str, body: Optional[str] = None) -> dict:
+        body = body or " ".join(f"word{self.random.randrange(1000)}" for _ in range(self.random.randrange(3, 30)))
+        content = {"msgtype": msgtype, "body": body}
+        if msgtype == "m.image":
+            content.update(url=f"mxc://{self.server}/{self.counter}", info={
+                "h": 480, "w": 640, "mimetype": "image/png", "size": 123456,
+                "thumbnail_info": {"h": 48, "w": 64, "mimetype": "image/png", "size": 1234},
+                "thumbnail_url": f"mxc://{self.server}/t{self.counter}",
+            })
+        elif msgtype == "m.file":
+            content.update(filename="report.pdf", url=f"mxc://{self.server}/{self.counter}", info={
+                "mimetype": "application/pdf", "size": 654321,
+            })
+        elif self.random.random() < 0.1:
+            content["m.relates_to"] = {"m.in_reply_to": {"event_id": f"$1:{self.server}"}}
+        return self._envelope("m.room.message", content, sender)
+
+    def state(self, event_type: str, users: int) -> dict:
+        sender = self._user(users)
+        if event_type == "m.room.member":
+            user = self._user(users)
+            return self._envelope(event_type, {"membership": "join", "displayname": user[1:].split(":")[0]}, sender, user)
+        elif event_type == "m.room.name":
+            content = {"name": f"Room {self.random.randrange(10000)}"}
+        elif event_type == "m.room.topic":
+            content = {"topic": f"Topic {self.random.randrange(10000)}"}
+        elif event_type == "m.room.power_levels":
+            content = {"users": {self._user(users): 100}, "users_default": 0}
+        else:
+            content = {"alias": f"#room{self.random.randrange(10000)}:{self.server}"}
+        return self._envelope(event_type, content, sender, "")
+
+    def room(self, events: int, users: int, message_mix: Dict[str, float], state_churn: float, initial: bool) -> dict:
+        state = [self.state(event_type, users) for event_type in STATE_TYPES] if initial else []
+        if initial:
+            state.extend(self.state("m.room.member", users) for _ in range(users))
+        msgtypes = list(message_mix)
+        weights = list(message_mix.values())
+        timeline = []
+        for _ in range(events):
+            if self.random.random() < state_churn:
+                timeline.append(self.state(self.random.choice(STATE_TYPES), users))
+            else:
+                timeline.append(self.message(self.random.choices(msgtypes, weights)[0], self._user(users)))
+        return {
+            "summary": {"m.joined_member_count": users, "m.invited_member_count": 0},
+            "state": {"events": state},
+            "timeline": {"events": timeline, "limited": False, "prev_batch": f"p{self.counter}"},
+            "ephemeral": {"events": [{
+                "type": "m.receipt",
+                "content": {timeline[-1]["event_id"]: {"m.read": {self._user(users): {"ts": self.ts}}}},
+            }] if timeline else []},
+            "account_data": {"events": []},
+        }
+
+    def sync(
+        self,
+        rooms: int = 100,
+        events_per_room: int = 20,
+        users_per_room: int = 20,
+        message_mix: Optional[Dict[str, float]] = None,
+        state_churn: float = 0.05,
+        initial: bool = True,
+    ) -> dict:
+        message_mix = message_mix or MESSAGE_MIX
+        return {
+            "next_batch": f"s{self.counter}",
+            "presence": {"events": []},
+            "rooms": {
+                "join": {
+                    f"!room{n}:{self.server}": self.room(events_per_room, users_per_room, message_mix, state_churn, initial)
+                    for n in range(rooms)
+                },
+                "invite": {},
+                "leave": {},
+            },
+        }
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import copy
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from morpheus.core.cache import AliasCache
+from morpheus.core.client import Client
+from morpheus.core.events import MessageEvent
+from morpheus.core.room import Room
+from morpheus.exts.bot import Bot
+
+from .payloads import PayloadGenerator
+
+
+class StaticAPI:
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.alias_cache = AliasCache()
+        self.hooks = []
+
+    async def get_sync(self, *args, **kwargs) -> dict:
+        return self.payload
+
+    async def send_receipt(self, *args, **kwargs) -> dict:
+        return {}
+
+    async def room_send(self, *args, **kwargs) -> dict:
+        return {}
+
+
+def timeline_events(payload: dict) -> List[Tuple[str, dict]]:
+    return [
+        (room_id, event)
+        for room_id, room in payload["rooms"]["join"].items()
+        for event in room["state"]["events"] + room["timeline"]["events"]
+    ]
+
+
+def new_client(cls=Client, payload: dict = None):
+    client = cls("!")
+    client.user_id = "@bench:bench.local"
+    client.loop = asyncio.get_event_loop()
+    client.api = StaticAPI(payload)
+    return client
+
+
+def stage_decode(payload: dict):
+    client = new_client()
+    events = timeline_events(payload)
+    rooms = {room_id: Room(room_id, client) for room_id in payload["rooms"]["join"]}
+
+    # Decoded events are returned so peak memory includes what they hold on to
+    def run():
+        return [client.process_event(event, rooms[room_id]) for room_id, event in events]
+    return run, len(events)
+
+
+def stage_decode_lazy(payload: dict):
+    client = new_client()
+    client.lazy_content = True
+    events = timeline_events(payload)
+    rooms = {room_id: Room(room_id, client) for room_id in payload["rooms"]["join"]}
+
+    def run():
+        return [client.process_event(event, rooms[room_id]) for room_id, event in events]
+    return run, len(events)
+
+
+def stage_from_dict(payload: dict):
+    client = new_client()
+    events = [event for _, event in timeline_events(payload) if event["type"] == "m.room.message"]
+    room = Room("!bench:bench.local", client)
+
+    def run():
+        return [MessageEvent.from_dict(client, event, room) for event in events]
+    return run, len(events)
+
+
+def stage_room_state(payload: dict):
+    client = new_client()
+    rooms = {room_id: Room(room_id, client) for room_id in payload["rooms"]["join"]}
+    events = [
+        (rooms[room_id], client.process_event(event, rooms[room_id]))
+        for room_id, event in timeline_events(payload)
+        if event.get("state_key") is not None
+    ]
+
+    def run():
+        for room, event in events:
+            room._update_state(event)
+    return run, len(events)
+
+
+def stage_sync(payload: dict):
+    async def handler(event):
+        pass
+
+    def run():
+        client = new_client(payload=payload)
+        client.register_handler("m.room.message", handler)
+
+        async def sync():
+            await client.sync()
+            await client.dispatcher.join()
+            await client.dispatcher.close()
+        client.loop.run_until_complete(sync())
+    return run, len(timeline_events(payload))
+
+
+def stage_command(payload: dict):
+    bot = new_client(Bot, payload)
+    room = Room("!bench:bench.local", bot)
+
+    async def noop(ctx, *args):
+        pass
+
+    for n in range(100):
+        bot.add_command(f"cmd{n}", [f"alias{n}"], noop)
+    events = [
+        bot.process_event(event, room)
+        for _, event in timeline_events(payload)
+        if event["type"] == "m.room.message" and event["content"]["msgtype"] == "m.text"
+    ]
+    for n, event in enumerate(events):
+        if n % 2 == 0:
+            event.content.body = f"!cmd{n % 100} one two"
+
+    def run():
+        async def process():
+            for event in events:
+                await bot.process_command(event)
+        bot.loop.run_until_complete(process())
+    return run, len(events)
+
+
+STAGES: Dict[str, Callable[[dict], Tuple[Callable[[], None], int]]] = {
+    "decode": stage_decode,
+    "decode_lazy": stage_decode_lazy,
+    "from_dict": stage_from_dict,
+    "room_state": stage_room_state,
+    "sync": stage_sync,
+    "command": stage_command,
+}
+
+
+def measure(stage: Callable[[dict], Tuple[Callable[[], None], int]], payload: dict, repeat: int) -> dict:
+    timings = []
+    count = 0
+    for _ in range(repeat):
+        run, count = stage(copy.deepcopy(payload))
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    # Memory is measured on a separate run since tracing slows everything down
+    run, count = stage(copy.deepcopy(payload))
+    gc.collect()
+    tracemalloc.start()
+    output = run()
+    current, peak = tracemalloc.get_traced_memory()
+    # tracemalloc only sees blocks that are still alive, freed temporaries are not counted
+    retained_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    del output
+    best = min(timings)
+    return {
+        "events": count,
+        "seconds": best,
+        "events_per_sec": count / best if best else 0.0,
+        "retained_blocks": retained_blocks,
+        "retained_bytes": current,
+        "peak_bytes": peak,
+    }
+
+
+def compare(results: dict, baseline: dict) -> List[str]:
+    lines = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        for key in ("events_per_sec", "peak_bytes", "retained_blocks"):
+            if base.get(key):
+                change = (result[key] - base[key]) / abs(base[key]) * 100
+                lines.append(f"{name:<12} {key:<18} {base[key]:>14.1f} -> {result[key]:>14.1f} ({change:+.1f}%)")
+    return lines
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the morpheus sync decode and dispatch pipeline")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--events", type=int, default=20, help="timeline events per room")
+    parser.add_argument("--users", type=int, default=20, help="members per room")
+    parser.add_argument("--state-churn", type=float, default=0.05, help="share of timeline events that are state")
+    parser.add_argument("--text-ratio", type=float, default=None, help="share of m.text messages, the rest are media")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stage", action="append", choices=sorted(STAGES), help="stages to run, all by default")
+    parser.add_argument("--save", help="write the results to this file as a baseline")
+    parser.add_argument("--compare", help="compare the results with a saved baseline")
+    args = parser.parse_args(argv)
+
+    mix = None
+    if args.text_ratio is not None:
+        rest = (1 - args.text_ratio) / 3
+        mix = {"m.text": args.text_ratio, "m.notice": rest, "m.image": rest, "m.file": rest}
+    payload = PayloadGenerator(args.seed).sync(args.rooms, args.events, args.users, mix, args.state_churn)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    results = {}
+    for name in args.stage or STAGES:
+        results[name] = result = measure(STAGES[name], payload, args.repeat)
+        print(
+            f"{name:<12} {result['events']:>8} events {result['events_per_sec']:>12.0f} ev/s "
+            f"peak {result['peak_bytes'] / 1024:>10.1f} KiB retained blocks {result['retained_blocks']:>8}"
+        )
+
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(results, json.load(f)):
+                print(line)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"params": vars(args), "python": sys.version, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
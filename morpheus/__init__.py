@@ -0,0 +1,5 @@
+import sys
+
+# Slotted and keyword only dataclass fields need 3.10
+if sys.version_info < (3, 10):
+    raise RuntimeError("morpheus requires Python 3.10 or newer")
@@ -1,15 +1,26 @@
 import json
-from typing import Union
+import logging
+import time
+from typing import Union, Optional, List, AsyncIterator
 import uuid
 import aiohttp
 from aiohttp.client_exceptions import ClientConnectionError
 import asyncio
 from urllib.parse import quote, urlencode, urlparse
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from .codec import JSONCodec, default_codec
+from .cache import AliasCache
+from .scheduler import SendScheduler, PRIORITY_NORMAL, PRIORITY_LOW
+from .metrics import RequestHook, RequestInfo
+from .media import MediaSource, Source, DEFAULT_CHUNK_SIZE, parse_mxc, write_chunks
+from .filter import RoomEventFilter
 
 MATRIX_API = "/_matrix/client/r0"
 MATRIX_MEDIA = "/_matrix/media/r0"
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class APIConfig:
@@ -18,6 +29,45 @@ class APIConfig:
     backoff_factor: float = 0.1
     ssl: bool = None
     proxy: str = None
+    # Connection pool, pass a shared connector to let several API instances use one pool
+    connector: Optional[aiohttp.BaseConnector] = None
+    limit: int = 100
+    limit_per_host: int = 20
+    keepalive_timeout: float = 30.0
+    ttl_dns_cache: Optional[int] = 300
+    # Timeouts in seconds, None disables the timeout
+    total_timeout: Optional[float] = None
+    connect_timeout: Optional[float] = 10.0
+    read_timeout: Optional[float] = 30.0
+    # Added on top of the sync long-poll timeout so the read does not expire before the server answers
+    sync_read_margin: float = 15.0
+    # Used for request and response bodies, orjson is picked when it is installed
+    json_codec: Optional[JSONCodec] = None
+    alias_cache_ttl: float = 300.0
+    alias_cache_size: int = 1024
+    # Outbound sends per second, globally and per room, 0 disables the limit
+    send_rate: float = 0.0
+    send_burst: int = 10
+    room_send_rate: float = 0.0
+    room_send_burst: int = 5
+    # Called around every request attempt, see MetricsRecorder
+    hooks: List[RequestHook] = field(default_factory=list)
+
+    def create_connector(self) -> aiohttp.TCPConnector:
+        return aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.ttl_dns_cache,
+            use_dns_cache=self.ttl_dns_cache is not None,
+        )
+
+    def create_timeout(self, read_timeout: Optional[float] = None) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(
+            total=self.total_timeout,
+            sock_connect=self.connect_timeout,
+            sock_read=read_timeout or self.read_timeout,
+        )
 
 
 class API:
@@ -40,7 +90,19 @@ class API:
         self.device_name = device_name
         self.access_token = None
         self.config = config
-        self.client_session = aiohttp.ClientSession()
+        self.codec: JSONCodec = config.json_codec or default_codec()
+        self.client_session: Optional[aiohttp.ClientSession] = None
+        self.alias_cache = AliasCache(config.alias_cache_ttl, config.alias_cache_size)
+        self.scheduler = SendScheduler(
+            config.send_rate, config.send_burst, config.room_send_rate, config.room_send_burst
+        )
+        self.hooks: List[RequestHook] = list(config.hooks)
+
+    def add_hook(self, hook: RequestHook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: RequestHook):
+        self.hooks.remove(hook)
 
     def build_url(
         self, endpoint: str, request_type: str = None, query: dict = None
@@ -48,7 +110,12 @@ class API:
         path = f'{MATRIX_MEDIA if request_type == "MEDIA" else MATRIX_API}/{endpoint}'
         path = self.base_url + quote(path)
         if query:
-            path += f"?{urlencode(query).lower()}"
+            # Only booleans need lowering, tokens and filter ids are case sensitive
+            query = {
+                key: str(value).lower() if isinstance(value, bool) else value
+                for key, value in query.items()
+            }
+            path += f"?{urlencode(query)}"
         return path
 
     def get_wait_time(self, num_timeouts: int) -> float:
@@ -60,57 +127,142 @@ class API:
             self.config.max_wait_time,
         )
 
+    def get_session(self) -> aiohttp.ClientSession:
+        if not self.client_session or self.client_session.closed:
+            if self.config.connector:
+                connector = self.config.connector
+                connector_owner = False
+            else:
+                connector = self.config.create_connector()
+                connector_owner = True
+            self.client_session = aiohttp.ClientSession(
+                connector=connector,
+                connector_owner=connector_owner,
+                timeout=self.config.create_timeout(),
+            )
+        return self.client_session
+
     async def close(self):
         if self.client_session:
             await self.client_session.close()
             self.client_session = None
 
     async def _send(
-        self, method: str, path: str, data: dict = None, headers: dict = {}
-    ) -> Union[dict, bytes]:
-        if not self.client_session:
-            self.client_session = aiohttp.ClientSession()
-
-        raw_resp = await self.client_session.request(
+        self,
+        method: str,
+        path: str,
+        data: dict = None,
+        headers: dict = {},
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+        info: Optional[RequestInfo] = None,
+        stream: bool = False,
+    ) -> Union[dict, bytes, aiohttp.ClientResponse]:
+        kwargs = {"timeout": timeout} if timeout else {}
+        if isinstance(data, MediaSource):
+            # Media bodies are streamed in chunks, with a length header when the size is known
+            bytes_out = data.size or 0
+            if data.size is not None:
+                headers = {**headers, "Content-Length": str(data.size)}
+            data = data.open()
+        else:
+            if data is not None and not isinstance(data, bytes):
+                data = self.codec.dumps(data)
+            bytes_out = len(data) if data is not None else 0
+        raw_resp = await self.get_session().request(
             method,
             path,
-            json=data,
+            data=data,
             ssl=self.config.ssl,
             proxy=self.config.proxy,
             headers=headers,
+            **kwargs,
         )
+        if info is not None:
+            info.status = raw_resp.status
+            info.bytes_out = bytes_out
+        if stream and raw_resp.status == 200:
+            # The caller reads the body and releases the response
+            if info is not None:
+                info.bytes_in = raw_resp.content_length or 0
+            return raw_resp
+        body = await raw_resp.read()
+        if info is not None:
+            info.bytes_in = len(body)
         if raw_resp.content_type == "application/json":
-            return await raw_resp.json()
+            return self.codec.loads(body)
         else:
-            return await raw_resp.read()
+            return body
+
+    def _pre_request(self, info: RequestInfo, attempt: int):
+        info.attempt = attempt
+        info.status = None
+        info.bytes_out = info.bytes_in = 0
+        info.rate_limited = False
+        info.error = None
+        for hook in self.hooks:
+            hook.pre_request(info)
+        info.start = time.perf_counter()
+
+    def _post_request(self, info: RequestInfo):
+        info.duration = time.perf_counter() - info.start
+        for hook in self.hooks:
+            hook.post_request(info)
 
     async def send(
-        self, method: str, path: str, data: dict = None, content_type: str = None
-    ) -> dict:
+        self,
+        method: str,
+        path: str,
+        data: dict = None,
+        content_type: str = None,
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+        room_id: Optional[str] = None,
+        priority: Optional[int] = None,
+        stream: bool = False,
+    ) -> Union[dict, bytes, aiohttp.ClientResponse]:
         if not self.access_token:
             raise RuntimeError("Client is not logged in")
 
         headers = {
             "Authorization": f"Bearer {self.access_token}",
-            "content_type": content_type or "application/json",
+            "Content-Type": content_type or "application/json",
         }
 
         timeouts = 0
+        # Nothing is allocated for instrumentation unless a hook is installed
+        info = RequestInfo(method, path) if self.hooks else None
 
-        for _ in range(self.config.max_retry or 1):
+        for attempt in range(1, (self.config.max_retry or 1) + 1):
             try:
-                resp = await self._send(method, path, data, headers)
+                # Requests with a priority go through the send scheduler
+                if priority is not None:
+                    await self.scheduler.acquire(room_id, priority)
+                if info is not None:
+                    self._pre_request(info, attempt)
+                resp = await self._send(method, path, data, headers, timeout, info, stream)
+                retry_after_ms = resp.get("retry_after_ms") if isinstance(resp, dict) else None
+                if info is not None:
+                    info.rate_limited = bool(retry_after_ms)
+                    self._post_request(info)
 
-                if isinstance(resp, bytes):
-                    break
-
-                if isinstance(resp, dict) and resp.get("retry_after_ms"):
-                    await asyncio.sleep(resp["retry_after_ms"] / 1000)
+                if retry_after_ms:
+                    logger.debug("Rate limited on %s %s, retrying in %sms", method, path, retry_after_ms)
+                    self.scheduler.backoff(retry_after_ms)
+                    if priority is None:
+                        await asyncio.sleep(retry_after_ms / 1000)
                 else:
                     break
-            except (asyncio.TimeoutError, ClientConnectionError, TimeoutError):
+            except (asyncio.TimeoutError, ClientConnectionError, TimeoutError) as e:
+                if info is not None:
+                    info.error = e
+                    self._post_request(info)
                 timeouts += 1
+                logger.debug("%s %s failed with %r, attempt %d", method, path, e, attempt)
                 await asyncio.sleep(self.get_wait_time(timeouts))
+            except Exception as e:
+                if info is not None:
+                    info.error = e
+                    self._post_request(info)
+                raise
         else:
             raise RuntimeWarning(f"Max retries reached for {method} - {path} | {data}")
 
@@ -135,7 +287,7 @@ class API:
         if self.device_name:
             data["device_name"] = self.device_name
 
-        headers = {"content_type": "application/json"}
+        headers = {"Content-Type": "application/json"}
         resp = await self._send("post", path, data=data, headers=headers)
         self.access_token = resp.get("access_token")
         self.device_id = resp.get("device_id")
@@ -153,23 +305,49 @@ class API:
         await self.send("POST", path)
         self.access_token = None
 
-    async def room_send(self, room_id: str, event_type: str, content: dict):
-        txnid = uuid.uuid4()
+    async def get_room_id(self, room_id: str) -> str:
         if room_id.startswith("!") and ":" in room_id:
-            path = self.build_url(f"rooms/{room_id}/send/{event_type}/{txnid}")
+            return room_id
         elif room_id.startswith("#") and ":" in room_id:
-            path = self.build_url(f"directory/room/{room_id}")
-            resp = await self.send("GET", path)
-            if resp.get("room_id"):
-                path = self.build_url(
-                    f'rooms/{resp["room_id"]}/send/{event_type}/{txnid}'
-                )
-            else:
-                raise RuntimeWarning(resp)
+            return await self.resolve_alias(room_id)
         else:
             raise RuntimeWarning(f"{room_id} is not a valid room id or alias")
 
-        return await self.send("PUT", path, data=content)
+    async def room_send(
+        self, room_id: str, event_type: str, content: Union[dict, bytes], priority: int = PRIORITY_NORMAL
+    ):
+        txnid = uuid.uuid4()
+        room_id = await self.get_room_id(room_id)
+        path = self.build_url(f"rooms/{room_id}/send/{event_type}/{txnid}")
+        return await self.send("PUT", path, data=content, room_id=room_id, priority=priority)
+
+    async def send_state(
+        self,
+        room_id: str,
+        event_type: str,
+        content: dict,
+        state_key: str = "",
+        priority: int = PRIORITY_NORMAL,
+    ):
+        room_id = await self.get_room_id(room_id)
+        path = self.build_url(f"rooms/{room_id}/state/{event_type}/{state_key}")
+        return await self.send("PUT", path, data=content, room_id=room_id, priority=priority)
+
+    async def send_receipt(
+        self, room_id: str, event_id: str, receipt_type: str = "m.read", priority: int = PRIORITY_LOW
+    ):
+        path = self.build_url(f"rooms/{room_id}/receipt/{receipt_type}/{event_id}")
+        return await self.send("POST", path, data={}, room_id=room_id, priority=priority)
+
+    async def resolve_alias(self, alias: str) -> str:
+        return await self.alias_cache.resolve(alias, self._lookup_alias)
+
+    async def _lookup_alias(self, alias: str) -> str:
+        path = self.build_url(f"directory/room/{alias}")
+        resp = await self.send("GET", path)
+        if resp.get("room_id"):
+            return resp["room_id"]
+        raise RuntimeWarning(resp)
 
     async def get_joined_rooms(self):
         path = self.build_url("joined_rooms")
@@ -179,6 +357,39 @@ class API:
         else:
             return []
 
+    async def create_filter(self, filter_dict: dict) -> str:
+        path = self.build_url(f"user/{self.user_id}/filter")
+        resp = await self.send("POST", path, data=filter_dict)
+        if not resp.get("filter_id"):
+            raise RuntimeWarning(resp)
+        return resp["filter_id"]
+
+    async def get_messages(
+        self,
+        room_id: str,
+        start: str = None,
+        direction: str = "b",
+        limit: int = 10,
+        end: str = None,
+        room_filter: Union[dict, RoomEventFilter] = None,
+    ) -> dict:
+        query = {"dir": direction, "limit": limit}
+        if start:
+            query["from"] = start
+        if end:
+            query["to"] = end
+        if room_filter:
+            if isinstance(room_filter, RoomEventFilter):
+                room_filter = room_filter.to_dict()
+            query["filter"] = self.codec.dumps(room_filter)
+            if isinstance(query["filter"], bytes):
+                query["filter"] = query["filter"].decode()
+        path = self.build_url(f"rooms/{room_id}/messages", query=query)
+        resp = await self.send("GET", path)
+        if resp.get("errcode"):
+            raise RuntimeWarning(resp)
+        return resp
+
     async def get_sync(
         self,
         query_filter: str = None,
@@ -198,7 +409,59 @@ class API:
             query["since"] = since
 
         path = self.build_url("sync", query=query)
-        print(path)
-        resp = await self.send("GET", path)
+        logger.debug("Syncing since %s with timeout %sms", since, timeout)
+        read_timeout = timeout / 1000 + self.config.sync_read_margin
+        resp = await self.send(
+            "GET", path, timeout=self.config.create_timeout(read_timeout)
+        )
 
         return resp
+
+    async def upload(
+        self,
+        source: Union[Source, MediaSource],
+        content_type: str = None,
+        filename: str = None,
+        size: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> str:
+        path = self.build_url("upload", "MEDIA", {"filename": filename} if filename else None)
+        body = source if isinstance(source, MediaSource) else MediaSource(source, size, chunk_size)
+        resp = await self.send("POST", path, data=body, content_type=content_type or "application/octet-stream")
+        if not isinstance(resp, dict) or not resp.get("content_uri"):
+            raise RuntimeWarning(resp)
+        return resp["content_uri"]
+
+    async def iter_media(
+        self,
+        mxc_uri: str,
+        width: int = None,
+        height: int = None,
+        method: str = "scale",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> AsyncIterator[bytes]:
+        server_name, media_id = parse_mxc(mxc_uri)
+        if width or height:
+            query = {"width": width or height, "height": height or width, "method": method}
+            path = self.build_url(f"thumbnail/{server_name}/{media_id}", "MEDIA", query)
+        else:
+            path = self.build_url(f"download/{server_name}/{media_id}", "MEDIA")
+        resp = await self.send("GET", path, stream=True)
+        if not isinstance(resp, aiohttp.ClientResponse):
+            raise RuntimeWarning(resp)
+        try:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                yield chunk
+        finally:
+            resp.release()
+
+    async def download(
+        self,
+        mxc_uri: str,
+        destination,
+        width: int = None,
+        height: int = None,
+        method: str = "scale",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> int:
+        return await write_chunks(self.iter_media(mxc_uri, width, height, method, chunk_size), destination)
@@ -0,0 +1,294 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple, Callable, Awaitable
+
+from .utils import SingleFlight
+
+
+class AliasCache:
+    def __init__(self, ttl: float = 300.0, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lookups = SingleFlight()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, alias: str) -> Optional[str]:
+        entry = self._entries.get(alias)
+        if entry is None:
+            return None
+        room_id, expires = entry
+        if expires < time.monotonic():
+            del self._entries[alias]
+            return None
+        self._entries.move_to_end(alias)
+        return room_id
+
+    def put(self, alias: str, room_id: str):
+        self._entries[alias] = (room_id, time.monotonic() + self.ttl)
+        self._entries.move_to_end(alias)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, alias: str):
+        self._entries.pop(alias, None)
+
+    def invalidate_room(self, room_id: str):
+        for alias in [alias for alias, entry in self._entries.items() if entry[0] == room_id]:
+            del self._entries[alias]
+
+    async def resolve(self, alias: str, lookup: Callable[[str], Awaitable[str]]) -> str:
+        room_id = self.get(alias)
+        if room_id is not None:
+            return room_id
+
+        # Concurrent lookups of the same alias wait on the first request
+        return await self._lookups.run(alias, self._lookup, alias, lookup)
+
+    async def _lookup(self, alias: str, lookup: Callable[[str], Awaitable[str]]) -> str:
+        room_id = await lookup(alias)
+        self.put(alias, room_id)
+        return room_id
+
+
+# Rough cost of the event, unsigned and content objects on top of the raw strings
+EVENT_OVERHEAD = 512
+
+
+def estimate_size(value) -> int:
+    if isinstance(value, str):
+        return 49 + len(value)
+    elif isinstance(value, dict):
+        return 64 + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return 56 + sum(estimate_size(item) for item in value)
+    return 28
+
+
+def relation_target(content: dict) -> Optional[str]:
+    relates_to = content.get("m.relates_to")
+    if not isinstance(relates_to, dict):
+        return None
+    in_reply_to = relates_to.get("m.in_reply_to")
+    if isinstance(in_reply_to, dict) and in_reply_to.get("event_id"):
+        return in_reply_to["event_id"]
+    # Reactions, edits and threads all point at their target with event_id
+    return relates_to.get("event_id")
+
+
+class CacheEntry:
+    __slots__ = ("event", "room_id", "sender", "relates_to", "size")
+
+    def __init__(self, event, room_id: str, sender: str, relates_to: Optional[str], size: int):
+        self.event = event
+        self.room_id = room_id
+        self.sender = sender
+        self.relates_to = relates_to
+        self.size = size
+
+
+class MessageCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, room_quota: int = 1000, evict_redacted: bool = False):
+        self.max_bytes = max_bytes
+        # Events kept per room, 0 disables the quota
+        self.room_quota = room_quota
+        # Redacted events are dropped instead of having their content stripped
+        self.evict_redacted = evict_redacted
+        self.size: int = 0
+        self.evictions: int = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._rooms: Dict[str, "OrderedDict[str, None]"] = {}
+        self._by_sender: Dict[str, Dict[str, None]] = {}
+        self._by_relation: Dict[str, Dict[str, None]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, event_id: str):
+        return event_id in self._entries
+
+    def get(self, event_id: str):
+        entry = self._entries.get(event_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(event_id)
+        self._rooms[entry.room_id].move_to_end(event_id)
+        return entry.event
+
+    def put(self, event, event_dict: Optional[dict] = None):
+        # With the raw event the size and relation are read without decoding the content
+        if event_dict is not None:
+            content = event_dict.get("content") or {}
+            size = EVENT_OVERHEAD + estimate_size(content)
+            relates_to = relation_target(content)
+        else:
+            size = EVENT_OVERHEAD
+            relates_to = self._event_relation(event)
+
+        event_id = event.event_id
+        if event_id in self._entries:
+            self.remove(event_id)
+        room_id = event.room.id if event.room is not None else None
+        entry = CacheEntry(event, room_id, event.sender, relates_to, size)
+        self._entries[event_id] = entry
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = OrderedDict()
+        room[event_id] = None
+        self._index(self._by_sender, entry.sender, event_id)
+        if relates_to:
+            self._index(self._by_relation, relates_to, event_id)
+        self.size += size
+
+        if self.room_quota:
+            while len(room) > self.room_quota:
+                self._evict(next(iter(room)))
+        while self.size > self.max_bytes and self._entries:
+            self._evict(next(iter(self._entries)))
+
+    @staticmethod
+    def _event_relation(event) -> Optional[str]:
+        content = event.content
+        relation = getattr(content, "relation", None) or getattr(content, "relates_to", None)
+        return getattr(relation, "event_id", None)
+
+    @staticmethod
+    def _index(index: Dict[str, Dict[str, None]], key: str, event_id: str):
+        events = index.get(key)
+        if events is None:
+            events = index[key] = {}
+        events[event_id] = None
+
+    @staticmethod
+    def _unindex(index: Dict[str, Dict[str, None]], key: str, event_id: str):
+        events = index.get(key)
+        if events is not None:
+            events.pop(event_id, None)
+            if not events:
+                del index[key]
+
+    def _evict(self, event_id: str):
+        self.remove(event_id)
+        self.evictions += 1
+
+    def remove(self, event_id: str):
+        entry = self._entries.pop(event_id, None)
+        if entry is None:
+            return None
+        room = self._rooms[entry.room_id]
+        del room[event_id]
+        if not room:
+            del self._rooms[entry.room_id]
+        self._unindex(self._by_sender, entry.sender, event_id)
+        if entry.relates_to:
+            self._unindex(self._by_relation, entry.relates_to, event_id)
+        self.size -= entry.size
+        return entry.event
+
+    def redact(self, event_id: str, redaction=None):
+        entry = self._entries.get(event_id)
+        if entry is None:
+            return None
+        if self.evict_redacted:
+            return self.remove(event_id)
+
+        from .content import ContentBase
+
+        event = entry.event
+        event.content = ContentBase()
+        if event.unsigned is not None:
+            event.unsigned.redacted_because = redaction
+        # A redacted reaction or reply no longer points at anything
+        if entry.relates_to:
+            self._unindex(self._by_relation, entry.relates_to, event_id)
+            entry.relates_to = None
+        self.size -= entry.size - EVENT_OVERHEAD
+        entry.size = EVENT_OVERHEAD
+        return event
+
+    def room_events(self, room_id: str) -> list:
+        room = self._rooms.get(room_id)
+        if not room:
+            return []
+        return [self._entries[event_id].event for event_id in room]
+
+    def by_sender(self, sender: str, room_id: Optional[str] = None) -> list:
+        entries = [self._entries[event_id] for event_id in self._by_sender.get(sender, ())]
+        return [entry.event for entry in entries if room_id is None or entry.room_id == room_id]
+
+    def related(self, event_id: str, event_type: Optional[str] = None, room_id: Optional[str] = None) -> list:
+        entries = [self._entries[related] for related in self._by_relation.get(event_id, ())]
+        return [
+            entry.event
+            for entry in entries
+            if (event_type is None or entry.event.type == event_type) and (room_id is None or entry.room_id == room_id)
+        ]
+
+    def clear_room(self, room_id: str):
+        for event_id in list(self._rooms.get(room_id, ())):
+            self.remove(event_id)
+
+    def room(self, room_id: str) -> "RoomMessageCache":
+        return RoomMessageCache(self, room_id)
+
+    def stats(self) -> dict:
+        return {
+            "events": len(self._entries),
+            "rooms": len(self._rooms),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+class RoomMessageCache:
+    # The slice of a MessageCache that belongs to one room
+    def __init__(self, cache: MessageCache, room_id: str):
+        self.cache = cache
+        self.room_id = room_id
+
+    def _owns(self, event_id: str) -> bool:
+        entry = self.cache._entries.get(event_id)
+        return entry is not None and entry.room_id == self.room_id
+
+    def __len__(self):
+        return len(self.cache._rooms.get(self.room_id, ()))
+
+    def __contains__(self, event_id: str):
+        return self._owns(event_id)
+
+    def __iter__(self):
+        return iter(list(self.cache._rooms.get(self.room_id, ())))
+
+    def __getitem__(self, event_id: str):
+        if not self._owns(event_id):
+            raise KeyError(event_id)
+        return self.cache.get(event_id)
+
+    def __setitem__(self, event_id: str, event):
+        self.cache.put(event)
+
+    def __delitem__(self, event_id: str):
+        if not self._owns(event_id):
+            raise KeyError(event_id)
+        self.cache.remove(event_id)
+
+    def get(self, event_id: str, default=None):
+        return self.cache.get(event_id) if self._owns(event_id) else default
+
+    def put(self, event, event_dict: Optional[dict] = None):
+        self.cache.put(event, event_dict)
+
+    def values(self) -> list:
+        return self.cache.room_events(self.room_id)
+
+    def by_sender(self, sender: str) -> list:
+        return self.cache.by_sender(sender, self.room_id)
+
+    def related(self, event_id: str, event_type: Optional[str] = None) -> list:
+        return self.cache.related(event_id, event_type, self.room_id)
+
+    def clear(self):
+        self.cache.clear_room(self.room_id)
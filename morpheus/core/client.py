@@ -1,8 +1,22 @@
 import asyncio
-from typing import Union, Optional, Dict, List
+import io
+import logging
+from typing import Union, Optional, Dict, List, Iterable, Tuple, AsyncIterator, Set
 
-from .api import API
-from .room import Room
+from .api import API, APIConfig
+from .room import Room, TRACKED_STATE_TYPES
+from .filter import Filter, EventFilter, RoomFilter, RoomEventFilter
+from .receipts import ReceiptCoalescer
+from .cache import MessageCache
+from .store import StoreBase
+from .dispatcher import HandlerDispatcher
+from .profiler import Profiler
+from .scheduler import PRIORITY_NORMAL, PRIORITY_LOW
+from .utils import as_completed_bounded, ImageInfo, FileInfo, VideoInfo, AudioInfo, ImageInfoBase
+from .content import MImageContent, MFileContent, MVideoContent, MAudioContent, content_to_dict
+from .media import MediaSource, MediaCache, Source, guess_mimetype, write_chunks
+
+logger = logging.getLogger(__name__)
 
 
 class Client:
@@ -18,13 +32,20 @@ class Client:
         self.token: Optional[str] = None
         self.rooms: Dict[str, Room] = {}
         self.api: Optional[API] = None
+        self.api_config: APIConfig = APIConfig()
         self.running: bool = False
         self.sync_timeout: int = 30000
         self.sync_since: Optional[str] = None
         self.sync_full_state: bool = False
         self.sync_set_presence: str = "online"
         self.sync_filter: Optional[str] = None
+        self.sync_auto_filter: bool = True
         self.sync_delay: Optional[str] = None
+        self.sync_room_concurrency: int = 1
+        # Sync batches in flight at once, above 1 the next /sync is fetched while the current one is processed
+        self.sync_pipeline_depth: int = 1
+        # State types kept in Room.state, extend it before run() to track more
+        self.tracked_state_types = set(TRACKED_STATE_TYPES)
         self.sync_process_dispatcher = {
             "presence": self.process_presence_events,
             "rooms": self.process_room_events,
@@ -33,6 +54,22 @@ class Client:
         self.event_dispatchers: Dict[str, List[callable]] = {}
         self.users = []
         self.loop: Optional[asyncio.AbstractEventLoop] = None
+        from .decoder import default_decoder
+        self.decoder = default_decoder
+        # Decode event content on first access instead of for every synced event
+        self.lazy_content: bool = False
+        self.receipts = ReceiptCoalescer(self)
+        self.dispatcher = HandlerDispatcher(self)
+        # Seconds handlers get to finish when the client stops before they are cancelled
+        self.shutdown_timeout: float = 10.0
+        self.store: Optional[StoreBase] = None
+        self.pending_state: Dict[str, List[dict]] = {}
+        # Rooms whose state was fetched again, the store replaces their state instead of updating it
+        self.replaced_state: Set[str] = set()
+        # Shared by every room, Room.message_cache is a per room view of it, set to None before run() to disable it
+        self.message_cache: Optional[MessageCache] = MessageCache()
+        self.profiler: Optional[Profiler] = None
+        self.media_cache: Optional[MediaCache] = None
 
     async def run(self, user_id: str = None, password: str = None, token: str = None, loop: Optional[asyncio.AbstractEventLoop] = None):
         if loop:
@@ -46,42 +83,169 @@ class Client:
         self.password = password
         self.token = token
         self.api = API(
-            base_url=self.homeserver, user_id=self.user_id, password=self.password, token=self.token
+            base_url=self.homeserver,
+            user_id=self.user_id,
+            password=self.password,
+            token=self.token,
+            config=self.api_config,
         )
         resp = await self.api.login()
         if resp.get("errcode"):
             raise RuntimeError(resp)
+        if self.store:
+            await self.load_store()
+        if self.media_cache:
+            self.media_cache.api = self.api
+            await self.media_cache.open()
+        if self.sync_filter is None and self.sync_auto_filter:
+            self.sync_filter = await self.api.create_filter(self.build_sync_filter().to_dict())
         self.running = True
-        while self.running:
-            await self.sync()
-            if self.sync_delay:
-                await asyncio.sleep(self.sync_delay)
+        try:
+            if self.sync_pipeline_depth > 1:
+                await self.sync_pipelined()
+            while self.running:
+                await self.sync()
+                if self.sync_delay:
+                    await asyncio.sleep(self.sync_delay)
+        finally:
+            self.running = False
+            await self.dispatcher.join(self.shutdown_timeout)
+            await self.flush_receipts()
+            await self.dispatcher.close()
+            if self.store:
+                await self.store.close()
+
+    async def flush_receipts(self):
+        # Receipts held back by the flush interval are still sent when the client stops
+        try:
+            await self.receipts.flush()
+        except Exception:
+            logger.exception("Failed to send the pending read receipts")
+
+    async def load_store(self):
+        await self.store.open()
+        next_batch, rooms = await self.store.load()
+        await self.load_state(rooms)
+        if next_batch and not self.sync_since:
+            self.sync_since = next_batch
+
+    async def load_state(self, rooms: Dict[str, List[dict]]):
+        for room_id, events in rooms.items():
+            if room_id not in self.rooms:
+                self.rooms[room_id] = Room(room_id, self)
+            room = self.rooms[room_id]
+            for event_dict in events:
+                await room.update_state(self.process_event(event_dict, room))
+
+    def get_handled_event_types(self) -> set:
+        return set(self.event_dispatchers)
+
+    def build_sync_filter(self) -> Filter:
+        handled = self.get_handled_event_types()
+        state_types = sorted(handled.union(self.tracked_state_types))
+        timeline_types = set(state_types)
+        if self.message_cache is not None:
+            # Cached messages are only kept current if their redactions and reactions are synced too
+            timeline_types.update(("m.room.redaction", "m.reaction"))
+        ephemeral_types = ["m.receipt"]
+        if "m.typing" in handled:
+            ephemeral_types.append("m.typing")
+        return Filter(
+            presence=EventFilter(types=["m.presence"] if "m.presence" in handled else []),
+            account_data=EventFilter(types=[]),
+            room=RoomFilter(
+                ephemeral=RoomEventFilter(types=ephemeral_types),
+                state=RoomEventFilter(types=state_types, lazy_load_members=True),
+                timeline=RoomEventFilter(types=sorted(timeline_types), lazy_load_members=True),
+                account_data=RoomEventFilter(types=[]),
+            ),
+        )
 
     async def sync(self):
+        resp = await self.fetch_sync(self.sync_since)
+        await self.process_sync(resp)
+        return resp
+
+    async def sync_pipelined(self):
+        slots = asyncio.Semaphore(self.sync_pipeline_depth)
+        batches: asyncio.Queue = asyncio.Queue()
+
+        async def fetch():
+            since = self.sync_since
+            try:
+                while self.running:
+                    # A slot is held from the start of the fetch until the batch has been processed
+                    await slots.acquire()
+                    resp = await self.fetch_sync(since)
+                    since = resp["next_batch"]
+                    await batches.put(resp)
+                    if self.sync_delay:
+                        await asyncio.sleep(self.sync_delay)
+            except Exception as e:
+                await batches.put(e)
+            else:
+                await batches.put(None)
+
+        fetcher = asyncio.ensure_future(fetch())
+        try:
+            while self.running:
+                resp = await batches.get()
+                if resp is None:
+                    break
+                if isinstance(resp, Exception):
+                    raise resp
+                # Batches are processed one at a time in the order they were fetched
+                await self.process_sync(resp)
+                slots.release()
+            # A fetch that failed while the last batch was processed is still reported after a stop
+            while not batches.empty():
+                resp = batches.get_nowait()
+                if isinstance(resp, Exception):
+                    raise resp
+        finally:
+            fetcher.cancel()
+            await asyncio.gather(fetcher, return_exceptions=True)
+
+    async def fetch_sync(self, since: Optional[str]) -> dict:
         resp = await self.api.get_sync(
             self.sync_filter,
-            self.sync_since,
+            since,
             self.sync_full_state,
             self.sync_set_presence,
             self.sync_timeout,
         )
         if resp.get("errcode"):
-            self.running = False
             raise RuntimeError(resp)
-        self.sync_since = resp["next_batch"]
-        for key, value in resp.items():
-            if key == "next_batch":
-                self.sync_since = value
-            else:
-                if key in self.sync_process_dispatcher:
-                    func = self.sync_process_dispatcher[key]
-                    await func(value)
         return resp
 
+    async def process_sync(self, resp: dict):
+        for key, value in resp.items():
+            if key in self.sync_process_dispatcher:
+                func = self.sync_process_dispatcher[key]
+                await func(value)
+        # Only checkpointed once the whole batch has been processed
+        self.sync_since = resp["next_batch"]
+        await self.receipts.maybe_flush()
+        if self.store:
+            self.store.save(self.sync_since, self.pending_state, self.replaced_state)
+            self.pending_state = {}
+            self.replaced_state = set()
+
+    def record_state(self, room_id: str, event_dict: dict):
+        event_dict = {key: value for key, value in event_dict.items() if key != "room"}
+        self.pending_state.setdefault(room_id, []).append(event_dict)
+
+    def replace_state(self, room_id: str, event_dicts: List[dict]):
+        # Anything recorded for the room earlier in this sync is covered by the new state
+        self.pending_state[room_id] = []
+        self.replaced_state.add(room_id)
+        for event_dict in event_dicts:
+            self.record_state(room_id, event_dict)
+
     async def process_presence_events(self, value: dict):
         events = value["events"]
         for event_dict in events:
-            event = self.process_event(event_dict)
+            event = self.decode_event(event_dict)
             # TODO Do something with presence event...
 
     async def process_room_events(self, value: dict):
@@ -90,49 +254,74 @@ class Client:
         await self.process_room_leave_events(value["leave"])
 
     async def process_room_join_events(self, rooms: dict):
-        from morpheus.core.events import StateEvent, MessageEvent
-        for room_id, data in rooms.items():
-            if room_id not in self.rooms:
-                self.rooms[room_id] = Room(room_id, self)
-            room = self.rooms[room_id]
+        if self.sync_room_concurrency <= 1 or len(rooms) <= 1:
+            for room_id, data in rooms.items():
+                await self.process_room_join(room_id, data)
+            return
+
+        # Rooms are independent of each other, events within a room are still handled in order
+        semaphore = asyncio.Semaphore(self.sync_room_concurrency)
+
+        async def process(room_id: str, data: dict):
+            async with semaphore:
+                await self.process_room_join(room_id, data)
+
+        await asyncio.gather(*(process(room_id, data) for room_id, data in rooms.items()))
+
+    async def process_room_join(self, room_id: str, data: dict):
+        from morpheus.core.events import StateEvent, RedactionEvent, RoomEvent
+        if room_id not in self.rooms:
+            self.rooms[room_id] = Room(room_id, self)
+        room = self.rooms[room_id]
+        room.resynced = False
+        if data.get("summary"):
+            room.update_summary(data["summary"])
+
+        # Process state events and update Room state
+        for event_dict in data["state"]["events"]:
+            event = self.decode_event(event_dict, room)
+            if event is None:
+                continue
+            if self.store:
+                self.record_state(room_id, event_dict)
+            # The state block already covers any gap, only timeline events are checked
+            await room.update_state(event, check_gap=False)
+            await self.dispatch(event, timeline=False)
+
+        # Process ephemeral events
+        for event in data['ephemeral']['events']:
+            if event['type'] == 'm.receipt':
+                room.update_read_receipts(event['content'])
+                # TODO Update read receipts for users
+            elif event['type'] == 'm.typing':
+                # TODO process typing messages
+                pass
 
-            # Process state events and update Room state
-            for event_dict in data["state"]["events"]:
-                event_dict["room"] = room
-                event = self.process_event(event_dict)
-                await room.update_state(event)
-                handlers = self.event_dispatchers.get(event.type)
-                if handlers:
-                    for handler in handlers:
-                        self.loop.create_task(self.invoke(handler, event))
-
-            # Process ephemeral events
-            for event in data['ephemeral']['events']:
-                if event['type'] == 'm.receipt':
-                    room.update_read_receipts(event['content'])
-                    # TODO Update read receipts for users
-                elif event['type'] == 'm.typing':
-                    # TODO process typing messages
-                    pass
-
-            # Process timeline
-            for event_dict in data["timeline"]["events"]:
-                event_dict["room"] = room
-                event = self.process_event(event_dict)
-                if isinstance(event, StateEvent):
+        # Process timeline
+        if data["timeline"].get("prev_batch"):
+            room.prev_batch = data["timeline"]["prev_batch"]
+        for event_dict in data["timeline"]["events"]:
+            event = self.decode_event(event_dict, room)
+            if event is None:
+                continue
+            # The whole batch happened before a refetch, so its state events are already part of the fetched state
+            if self.store and event_dict.get("state_key") is not None and not room.resynced:
+                self.record_state(room_id, event_dict)
+            if isinstance(event, StateEvent):
+                if not room.resynced:
                     await room.update_state(event)
-                elif isinstance(event, MessageEvent):
-                    if event.event_id not in room.message_cache:
-                        room.message_cache[event.event_id] = event
-                if room.read_receipts[self.user_id][1] < event.origin_server_ts:
-                    handlers = self.event_dispatchers.get(event.type)
-                    if handlers:
-                        for handler in handlers:
-                            self.loop.create_task(self.invoke(handler, event))
-                    try:
-                        await self.mark_event_read(event)
-                    except RuntimeError as e:
-                        pass
+            elif self.message_cache is None:
+                pass
+            elif isinstance(event, RedactionEvent):
+                # Room version 11 moved redacts into the content
+                self.message_cache.redact(event.redacts or (event_dict.get("content") or {}).get("redacts"), event)
+            elif isinstance(event, RoomEvent):
+                if event.event_id not in self.message_cache:
+                    self.message_cache.put(event, event_dict)
+            if room.read_receipts.get(self.user_id, (None, 0))[1] < event.origin_server_ts:
+                await self.dispatch(event)
+                if isinstance(event, RoomEvent):
+                    self.receipts.add(event)
 
     async def process_room_invite_events(self, rooms: dict):
         pass
@@ -143,32 +332,67 @@ class Client:
     async def process_group_events(self, value: dict):
         pass
 
-    def process_event(self, event: dict):
-        from .events import (
-            EventBase,
-            RoomEvent,
-            StateEvent,
-            RedactionEvent,
-            MessageEvent,
-        )
+    def process_event(self, event: dict, room: Optional[Room] = None):
+        return self.decoder.decode(self, event, room, lazy=self.lazy_content)
 
-        if event.get("redacted"):
-            return RedactionEvent.from_dict(self, event)
-        elif event.get("state_key") is not None:
-            return StateEvent.from_dict(self, event)
-        elif event["type"] == "m.presence":
-            return EventBase.from_dict(self, event)
-        elif event["type"] == "m.room.message":
-            return MessageEvent.from_dict(self, event)
-        elif event['type'] == 'm.room.redaction':
-            return RedactionEvent.from_dict(self, event)
-        else:
-            return RoomEvent.from_dict(self, event)
+    def decode_event(self, event: dict, room: Optional[Room] = None):
+        # A malformed event from the server is dropped, the rest of the sync is still processed
+        try:
+            return self.process_event(event, room)
+        except RuntimeWarning as e:
+            logger.warning("Dropped an event in %s: %s", room.id if room else "sync", e)
+            return None
+
+    async def dispatch(self, event, timeline: bool = True):
+        handlers = self.event_dispatchers.get(event.type)
+        if handlers:
+            for i, handler in enumerate(handlers):
+                # Sync lag is measured once per timeline event, when its first handler starts
+                await self.dispatcher.submit(handler, event, timeline and i == 0)
 
-    @staticmethod
-    async def invoke(handler: callable, event):
+    async def invoke(self, handler: callable, event):
         # handler must be a callable which takes the event as an argument
-        await handler(event)
+        if self.profiler is None:
+            await handler(event)
+        else:
+            await self.profiler.run(getattr(handler, "__qualname__", repr(handler)), handler(event))
+
+    def enable_profiling(self, block_threshold: float = 0.1) -> Profiler:
+        if self.profiler is None:
+            self.profiler = Profiler(block_threshold)
+        else:
+            self.profiler.block_threshold = block_threshold
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def enable_media_cache(self, directory: str, max_bytes: int = 1024 * 1024 * 1024) -> MediaCache:
+        # Can be called before run(), the API is bound once the client has logged in
+        self.media_cache = MediaCache(self.api, directory, max_bytes)
+        return self.media_cache
+
+    async def download(
+        self,
+        mxc_uri: str,
+        destination,
+        width: int = None,
+        height: int = None,
+        method: str = "scale",
+    ) -> int:
+        if self.media_cache is None:
+            return await self.api.download(mxc_uri, destination, width, height, method)
+        path = await self.media_cache.get_path(mxc_uri, width, height, method)
+        with open(path, "rb") as file:
+            return await write_chunks(MediaSource(file).open(), destination)
+
+    async def get_media(self, mxc_uri: str, width: int = None, height: int = None, method: str = "scale"):
+        # A read only mmap of the cached file with the media cache enabled, bytes otherwise
+        if self.media_cache is not None:
+            return await self.media_cache.get_mmap(mxc_uri, width, height, method)
+        buffer = io.BytesIO()
+        await self.api.download(mxc_uri, buffer, width, height, method)
+        return buffer.getvalue()
 
     def register_handler(self, event_type, handler: callable):
         if not event_type:
@@ -184,15 +408,59 @@ class Client:
     async def mark_event_read(self, event, receipt_type: str = 'm.read'):
         from .events import RoomEvent
         if isinstance(event, RoomEvent):
-            path = self.api.build_url(f'rooms/{event.room.id}/receipt/{receipt_type}/{event.event_id}')
-            await self.api.send('POST', path)
+            await self.api.send_receipt(event.room.id, event.event_id, receipt_type)
         else:
             raise RuntimeError(f'Event to mark read must be an instance of RoomEvent. Not {type(event)}')
 
-    async def send_room_message(self, room: Room, content: dict):
-        await self.api.room_send(room_id=room.id, event_type='m.room.message', content=content)
+    async def send_room_message(self, room: Room, content: dict, priority: int = PRIORITY_NORMAL):
+        return await self.api.room_send(room_id=room.id, event_type='m.room.message', content=content, priority=priority)
+
+    async def send_batch(
+        self,
+        messages: Iterable[Tuple[Union[Room, str], dict]],
+        event_type: str = 'm.room.message',
+        concurrency: int = 10,
+        priority: int = PRIORITY_LOW,
+    ) -> AsyncIterator[Tuple[Union[Room, str], Union[dict, Exception]]]:
+        # Each distinct content object is only encoded once
+        bodies: Dict[int, Tuple[dict, bytes]] = {}
+
+        def prepare(content: dict) -> bytes:
+            if id(content) not in bodies:
+                bodies[id(content)] = (content, self.api.codec.dumps(content))
+            return bodies[id(content)][1]
+
+        async def send(room: Union[Room, str], body: bytes):
+            room_id = room.id if isinstance(room, Room) else room
+            try:
+                return room, await self.api.room_send(room_id, event_type, body, priority=priority)
+            except Exception as e:
+                return room, e
+
+        sends = (send(room, prepare(content)) for room, content in messages)
+        async for result in as_completed_bounded(sends, concurrency):
+            yield result
+
+    async def send_many(
+        self,
+        rooms: Iterable[Union[Room, str]],
+        content: dict,
+        event_type: str = 'm.room.message',
+        concurrency: int = 10,
+        priority: int = PRIORITY_LOW,
+    ) -> AsyncIterator[Tuple[Union[Room, str], Union[dict, Exception]]]:
+        messages = ((room, content) for room in rooms)
+        async for result in self.send_batch(messages, event_type, concurrency, priority):
+            yield result
 
-    async def send_text(self, room: Room, body: str, formatted_body: str = None, format_type: str = None):
+    async def send_text(
+        self,
+        room: Room,
+        body: str,
+        formatted_body: str = None,
+        format_type: str = None,
+        priority: int = PRIORITY_NORMAL,
+    ):
         content = {
             'msgtype': 'm.notice',
             'body': body
@@ -201,12 +469,95 @@ class Client:
             content['format'] = format_type
             content['formatted_body'] = formatted_body
 
-        await self.send_room_message(room=room, content=content)
+        await self.send_room_message(room=room, content=content, priority=priority)
+
+    async def upload(self, source: Source, filename: str = None, mimetype: str = None, size: int = None) -> Tuple[str, MediaSource]:
+        media = MediaSource(source, size)
+        url = await self.api.upload(media, mimetype or guess_mimetype(filename), filename)
+        return url, media
+
+    async def send_image(
+        self,
+        room: Room,
+        source: Source,
+        filename: str,
+        mimetype: str = None,
+        size: int = None,
+        width: int = None,
+        height: int = None,
+        body: str = None,
+        thumbnail_url: str = None,
+        thumbnail_info: ImageInfoBase = None,
+        priority: int = PRIORITY_NORMAL,
+    ):
+        mimetype = mimetype or guess_mimetype(filename, "image/png")
+        url, media = await self.upload(source, filename, mimetype, size)
+        info = ImageInfo(
+            h=height, w=width, mimetype=mimetype, size=media.size,
+            thumbnail_info=thumbnail_info, thumbnail_url=thumbnail_url,
+        )
+        content = MImageContent(body=body or filename, msgtype='m.image', info=info, url=url)
+        return await self.send_room_message(room, content_to_dict(content), priority)
+
+    async def send_file(
+        self,
+        room: Room,
+        source: Source,
+        filename: str,
+        mimetype: str = None,
+        size: int = None,
+        body: str = None,
+        thumbnail_url: str = None,
+        thumbnail_info: ImageInfoBase = None,
+        priority: int = PRIORITY_NORMAL,
+    ):
+        mimetype = mimetype or guess_mimetype(filename)
+        url, media = await self.upload(source, filename, mimetype, size)
+        info = FileInfo(mimetype=mimetype, size=media.size, thumbnail_info=thumbnail_info, thumbnail_url=thumbnail_url)
+        content = MFileContent(body=body or filename, msgtype='m.file', filename=filename, info=info, url=url)
+        return await self.send_room_message(room, content_to_dict(content), priority)
+
+    async def send_video(
+        self,
+        room: Room,
+        source: Source,
+        filename: str,
+        mimetype: str = None,
+        size: int = None,
+        width: int = None,
+        height: int = None,
+        duration: int = None,
+        body: str = None,
+        thumbnail_url: str = None,
+        thumbnail_info: ImageInfoBase = None,
+        priority: int = PRIORITY_NORMAL,
+    ):
+        mimetype = mimetype or guess_mimetype(filename, "video/mp4")
+        url, media = await self.upload(source, filename, mimetype, size)
+        info = VideoInfo(
+            h=height, w=width, mimetype=mimetype, size=media.size, duration=duration,
+            thumbnail_info=thumbnail_info, thumbnail_url=thumbnail_url,
+        )
+        content = MVideoContent(body=body or filename, msgtype='m.video', info=info, url=url)
+        return await self.send_room_message(room, content_to_dict(content), priority)
+
+    async def send_audio(
+        self,
+        room: Room,
+        source: Source,
+        filename: str,
+        mimetype: str = None,
+        size: int = None,
+        duration: int = None,
+        body: str = None,
+        priority: int = PRIORITY_NORMAL,
+    ):
+        mimetype = mimetype or guess_mimetype(filename, "audio/ogg")
+        url, media = await self.upload(source, filename, mimetype, size)
+        info = AudioInfo(duration=duration, mimetype=mimetype, size=media.size)
+        content = MAudioContent(body=body or filename, msgtype='m.audio', info=info, url=url)
+        return await self.send_room_message(room, content_to_dict(content), priority)
 
     # TODO send_emote
     # TODO send_notice
-    # TODO send_image
-    # TODO send_file
-    # TODO send_audio
     # TODO send_location
-    # TODO send_video
@@ -0,0 +1,33 @@
+import json
+from typing import Any, Callable
+
+
+class JSONCodec:
+    def __init__(self, name: str, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return f"JSONCodec({self.name!r})"
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+# json.loads accepts bytes directly so responses are never copied into a str first
+stdlib_codec = JSONCodec("json", _stdlib_dumps, json.loads)
+
+
+def orjson_codec() -> JSONCodec:
+    import orjson
+
+    return JSONCodec("orjson", orjson.dumps, orjson.loads)
+
+
+def default_codec() -> JSONCodec:
+    try:
+        return orjson_codec()
+    except ImportError:
+        return stdlib_codec
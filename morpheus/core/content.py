@@ -1,5 +1,5 @@
-from dataclasses import dataclass, field
-from typing import Optional, List, Dict
+from dataclasses import dataclass, field, fields, is_dataclass
+from typing import Optional, List, Dict, Any, Callable
 
 from .utils import (
     EncryptedFile,
@@ -16,81 +16,88 @@ from .utils import (
 )
 
 
-@dataclass
+class LazyContent:
+    # Raw content kept on an event until its content is first read
+    __slots__ = ("factory", "raw")
+
+    def __init__(self, factory: Callable[[dict], "ContentBase"], raw: dict):
+        self.factory = factory
+        self.raw = raw
+
+    def decode(self) -> "ContentBase":
+        return self.factory(self.raw)
+
+
+@dataclass(slots=True)
 class ContentBase:
-    pass
+    # Keys the content class has no field for
+    extra: Optional[Dict[str, Any]] = field(default=None, kw_only=True, repr=False, compare=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageContentBase(ContentBase):
     body: str
     msgtype: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MTextContent(MessageContentBase):
     format: Optional[str] = None
     formatted_body: Optional[str] = None
-    msgtype = "m.text"
     relates_to: Optional[MessageRelation] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MEmoteContent(MTextContent):
-    msgtype = "m.emote"
+    pass
 
 
-@dataclass
+@dataclass(slots=True)
 class MNoticeContent(MTextContent):
-    msgtype = "m.notice"
+    pass
 
 
-@dataclass
+@dataclass(slots=True)
 class MImageContent(MessageContentBase):
-    msgtype = "m.image"
     info: ImageInfo
     url: Optional[str] = None
     file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MStickerContent(MImageContent):
-    msgtype = 'm.sticker'
+    pass
 
 
-@dataclass
+@dataclass(slots=True)
 class MFileContent(MessageContentBase):
-    msgtype = "m.file"
     filename: str
     info: FileInfo
     url: Optional[str] = None
     file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MAudioContent(MessageContentBase):
-    msgtype = "m.audio"
     info: AudioInfo
     url: Optional[str] = None
     file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MLocationContent(MessageContentBase):
-    msgtype = "m.location"
     geo_uri: str
     info: LocationInfo
 
 
-@dataclass
+@dataclass(slots=True)
 class MVideoContent(MessageContentBase):
-    msgtype = "m.video"
     info: VideoInfo
     url: Optional[str] = None
     file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class PresenceContent(ContentBase):
     presence: str
     last_active_ago: int = 0
@@ -100,17 +107,18 @@ class PresenceContent(ContentBase):
     status_message: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomAliasesContent(ContentBase):
     aliases: List[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomCanonicalAliasContent(ContentBase):
     alias: str
+    alt_aliases: Optional[List[str]] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomCreateContent(ContentBase):
     creator: str
     room_version: Optional[str] = "1"
@@ -118,12 +126,12 @@ class MRoomCreateContent(ContentBase):
     predecessor: Optional[PreviousRoom] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomJoinRulesContent(ContentBase):
     join_rule: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomMemberContent(ContentBase):
     membership: str
     is_direct: bool = False
@@ -133,7 +141,7 @@ class MRoomMemberContent(ContentBase):
     inviter: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomPowerLevelsContent(ContentBase):
     ban: int = 50
     events: Dict[str, int] = field(default_factory=dict)
@@ -147,47 +155,47 @@ class MRoomPowerLevelsContent(ContentBase):
     notifications: Dict[str, int] = field(default_factory=notification_power_levels_default_factory)
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomRedactionContent(ContentBase):
     reason: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomRelatedGroupsContent(ContentBase):
     groups: List[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomTopicContent(ContentBase):
     topic: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomNameContent(ContentBase):
     name: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomHistoryVisibilityContent(ContentBase):
     history_visibility: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomBotOptionsContent(ContentBase):
     options: Dict[str, dict]
 
 
-@dataclass
+@dataclass(slots=True)
 class MReactionContent(ContentBase):
     relation: ReactionRelation
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomAvatarContent(ContentBase):
     url: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MRoomGuestAccessContent(ContentBase):
     guest_access: str
 
@@ -219,3 +227,31 @@ content_dispatcher = {
     'm.room.avatar': MRoomAvatarContent,
     'm.room.guest_access': MRoomGuestAccessContent,
 }
+
+
+def content_to_dict(content) -> dict:
+    # The reverse of the decoder, None fields are left out and extra keys are sent back as they came
+    if isinstance(content, MRoomBotOptionsContent):
+        return dict(content.options or {})
+    result = dict(content.extra) if getattr(content, "extra", None) else {}
+    for f in fields(content):
+        value = getattr(content, f.name)
+        if value is None or f.name == "extra":
+            continue
+        if f.name == "relates_to" and isinstance(value, MessageRelation):
+            result["m.relates_to"] = {"m.in_reply_to": {"event_id": value.event_id}}
+        elif f.name == "relation":
+            result["m.relates_to"] = _to_json(value)
+        else:
+            result["m." + f.name[2:] if f.name.startswith("m_") else f.name] = _to_json(value)
+    return result
+
+
+def _to_json(value):
+    if is_dataclass(value):
+        return content_to_dict(value)
+    elif isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    elif isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    return value
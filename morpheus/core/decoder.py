@@ -0,0 +1,216 @@
+import dataclasses
+import typing
+from typing import Optional, Dict, Tuple, Callable, Any
+
+from .content import ContentBase, LazyContent, content_dispatcher
+from .utils import ReactionRelation, MessageRelation
+from .events import (
+    EventBase,
+    RoomEvent,
+    StateEvent,
+    RedactionEvent,
+    MessageEvent,
+    PresenceEvent,
+    UnsignedData,
+    lazy_event_classes,
+)
+
+
+# Envelope keys every event has, an event without them is rejected instead of decoded with None
+ENVELOPE_FIELDS = frozenset(("type", "sender", "event_id", "origin_server_ts", "state_key"))
+
+
+class FieldSpec:
+    __slots__ = ("names", "required", "critical", "converters", "has_extra")
+
+    def __init__(self, cls: type):
+        hints = typing.get_type_hints(cls)
+        fields = [f for f in dataclasses.fields(cls) if f.init and f.name != "extra"]
+        # Matrix keys such as m.federate map onto m_federate
+        self.names: Dict[str, str] = {}
+        for f in fields:
+            self.names[f.name] = f.name
+            self.names.setdefault(f.name.replace("_", "."), f.name)
+        self.required: Tuple[str, ...] = tuple(
+            f.name
+            for f in fields
+            if f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING
+        )
+        # Only events have an envelope, content fields are always optional
+        self.critical = frozenset(self.required) & ENVELOPE_FIELDS if issubclass(cls, EventBase) else frozenset()
+        self.converters: Dict[str, Callable[[Any], Any]] = {}
+        for f in fields:
+            nested = _nested_dataclass(hints.get(f.name))
+            if nested is not None:
+                self.converters[f.name] = _converter(nested)
+        self.has_extra = any(f.name == "extra" for f in dataclasses.fields(cls))
+
+
+_field_specs: Dict[type, FieldSpec] = {}
+
+
+def get_field_spec(cls: type) -> FieldSpec:
+    spec = _field_specs.get(cls)
+    if spec is None:
+        spec = _field_specs[cls] = FieldSpec(cls)
+    return spec
+
+
+def _nested_dataclass(hint) -> Optional[type]:
+    if typing.get_origin(hint) is typing.Union:
+        args = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+        hint = args[0] if len(args) == 1 else None
+    # Events are decoded by the decoder itself, they need the client and room
+    if isinstance(hint, type) and dataclasses.is_dataclass(hint) and not issubclass(hint, EventBase):
+        return hint
+    return None
+
+
+def _converter(cls: type) -> Callable[[Any], Any]:
+    def convert(value):
+        return decode_dataclass(cls, value) if isinstance(value, dict) else value
+    return convert
+
+
+def decode_dataclass(cls: type, data: dict, **known):
+    spec = get_field_spec(cls)
+    kwargs = known
+    extra = None
+    names = spec.names
+    converters = spec.converters
+    for key, value in data.items():
+        name = names.get(key)
+        if name is None or name in known:
+            if name is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+            continue
+        converter = converters.get(name)
+        kwargs[name] = converter(value) if converter else value
+    # Servers and clients routinely omit fields, missing ones are left as None rather than failing the event
+    for name in spec.required:
+        if name not in kwargs:
+            if name in spec.critical:
+                raise RuntimeWarning(f"{cls.__name__} is missing the required {name} key")
+            kwargs[name] = None
+    if extra and spec.has_extra:
+        kwargs["extra"] = extra
+    return cls(**kwargs)
+
+
+def _relates_to(content: dict, result: dict):
+    relates_to = content.get("m.relates_to")
+    if relates_to and relates_to.get("m.in_reply_to"):
+        result["relates_to"] = MessageRelation(event_id=relates_to["m.in_reply_to"].get("event_id"))
+
+
+def _message_content(content: dict) -> dict:
+    result = {key: value for key, value in content.items() if key != "m.relates_to" and key != "m.new_content"}
+    _relates_to(content, result)
+    return result
+
+
+def _sticker_content(content: dict) -> dict:
+    result = _message_content(content)
+    result["msgtype"] = "m.sticker"
+    return result
+
+
+def _reaction_content(content: dict) -> dict:
+    relation = content.get("m.relates_to") or {}
+    return {"relation": decode_dataclass(ReactionRelation, relation)}
+
+
+def _bot_options_content(content: dict) -> dict:
+    return {"options": content}
+
+
+content_transforms: Dict[str, Callable[[dict], dict]] = {
+    "m.sticker": _sticker_content,
+    "m.reaction": _reaction_content,
+    "m.room.bot.options": _bot_options_content,
+}
+
+
+def _event_class(event_type: str, has_state_key: bool) -> type:
+    if has_state_key:
+        return StateEvent
+    elif event_type == "m.presence":
+        return PresenceEvent
+    elif event_type == "m.room.message":
+        return MessageEvent
+    elif event_type == "m.room.redaction":
+        return RedactionEvent
+    else:
+        return RoomEvent
+
+
+def _content_class(event_type: str, msgtype: Optional[str]) -> type:
+    if event_type == "m.room.message":
+        return content_dispatcher.get(msgtype, ContentBase) if msgtype else ContentBase
+    return content_dispatcher.get(event_type, ContentBase)
+
+
+class DecodeEntry:
+    __slots__ = ("event_class", "content_class", "transform")
+
+    def __init__(self, event_class: type, content_class: type, transform: Callable[[dict], dict]):
+        self.event_class = event_class
+        self.content_class = content_class
+        self.transform = transform
+
+    def decode_content(self, content: dict) -> ContentBase:
+        return decode_dataclass(self.content_class, self.transform(content))
+
+    __call__ = decode_content
+
+
+class EventDecoder:
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.table: Dict[Tuple[str, Optional[str], bool], DecodeEntry] = {}
+        for key in content_dispatcher:
+            self._entry(key, None, False)
+            self._entry(key, None, True)
+            self._entry("m.room.message", key, False)
+
+    def _entry(self, event_type: str, msgtype: Optional[str], has_state_key: bool) -> DecodeEntry:
+        key = (event_type, msgtype, has_state_key)
+        entry = self.table.get(key)
+        if entry is None:
+            entry = DecodeEntry(
+                _event_class(event_type, has_state_key),
+                _content_class(event_type, msgtype),
+                content_transforms.get(event_type, _message_content),
+            )
+            # Event types and msgtypes come from other users so the table is capped
+            if len(self.table) < self.max_entries:
+                self.table[key] = entry
+        return entry
+
+    def decode(self, client, event_dict: dict, room=None, event_class: type = None, lazy: bool = False):
+        event_type = event_dict.get("type")
+        if not isinstance(event_type, str):
+            raise RuntimeWarning("Event is missing the required type key")
+        content = event_dict.get("content") or {}
+        msgtype = content.get("msgtype") if event_type == "m.room.message" else None
+        entry = self._entry(event_type, msgtype, event_dict.get("state_key") is not None)
+        if event_class is None:
+            event_class = RedactionEvent if event_dict.get("redacted") else entry.event_class
+
+        # Only the lazy classes have the content property, eager events keep a plain slot
+        if lazy and event_class in lazy_event_classes:
+            event_class = lazy_event_classes[event_class]
+            content = LazyContent(entry, content)
+        else:
+            content = entry.decode_content(content)
+        known = {"client": client, "content": content}
+        if issubclass(event_class, RoomEvent):
+            known["room"] = room if room is not None else event_dict.get("room")
+            unsigned = event_dict.get("unsigned")
+            known["unsigned"] = decode_dataclass(UnsignedData, unsigned) if isinstance(unsigned, dict) else unsigned
+        return decode_dataclass(event_class, event_dict, **known)
+
+
+default_decoder = EventDecoder()
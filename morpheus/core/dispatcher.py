@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Optional, Dict, List, Tuple, Hashable
+
+logger = logging.getLogger(__name__)
+
+# handler, event, the room id the room limit is counted against and whether the sync lag is recorded
+Item = Tuple[callable, object, Optional[str], bool]
+
+
+class HandlerDispatcher:
+    def __init__(
+        self,
+        client,
+        max_queue: int = 1000,
+        workers: int = 16,
+        room_limit: Optional[int] = None,
+        handler_limit: Optional[int] = None,
+    ):
+        from .client import Client
+
+        self.client: Client = client
+        self.max_queue = max_queue
+        self.worker_count = workers
+        self.room_limit = room_limit
+        self.handler_limit = handler_limit
+        # Only events that are within their room and handler limits are put on the queue
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.processed: int = 0
+        self.failures: int = 0
+        self.failures_by_handler: Counter = Counter()
+        self.last_failure: Optional[BaseException] = None
+        self._space: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._unfinished: int = 0
+        # Events held back by a limit, keyed by ("room", room_id) or ("handler", handler)
+        self._waiting: Dict[Hashable, deque] = {}
+        self._room_running: Counter = Counter()
+        self._handler_running: Counter = Counter()
+
+    @property
+    def queue_depth(self) -> int:
+        ready = self.queue.qsize() if self.queue else 0
+        return ready + self.waiting
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(items) for items in self._waiting.values())
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self._space = asyncio.Semaphore(self.max_queue)
+            self._idle = asyncio.Event()
+            self._idle.set()
+        loop = self.client.loop or asyncio.get_event_loop()
+        while len(self.workers) < self.worker_count:
+            self.workers.append(loop.create_task(self._worker()))
+
+    async def submit(self, handler: callable, event, timed: bool = False):
+        if not self.workers:
+            self.start()
+        # Waits while the queue is full, which holds back the sync loop instead of dropping events
+        await self._space.acquire()
+        self._unfinished += 1
+        self._idle.clear()
+        room = getattr(event, "room", None)
+        item = (handler, event, room.id if self.room_limit and room is not None else None, timed)
+        # Nothing overtakes an event that is already waiting on the same room or handler
+        for key in (("room", item[2]), ("handler", handler)):
+            if key in self._waiting:
+                self._waiting[key].append(item)
+                return
+        blocked = self._admit(item)
+        if blocked is not None:
+            self._waiting[blocked] = deque((item,))
+
+    def _admit(self, item: Item) -> Optional[Hashable]:
+        # Returns the key of the limit holding the event back, None once it has been queued for a worker
+        handler, event, room_id, timed = item
+        if room_id is not None and self._room_running[room_id] >= self.room_limit:
+            return ("room", room_id)
+        if self.handler_limit and self._handler_running[handler] >= self.handler_limit:
+            return ("handler", handler)
+        if room_id is not None:
+            self._room_running[room_id] += 1
+        if self.handler_limit:
+            self._handler_running[handler] += 1
+        self.queue.put_nowait(item)
+        return None
+
+    def _release(self, item: Item):
+        handler, event, room_id, timed = item
+        if room_id is not None:
+            self._room_running[room_id] -= 1
+            if not self._room_running[room_id]:
+                del self._room_running[room_id]
+        if self.handler_limit:
+            self._handler_running[handler] -= 1
+            if not self._handler_running[handler]:
+                del self._handler_running[handler]
+        self._wake(("room", room_id))
+        self._wake(("handler", handler))
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+
+    def _wake(self, key: Hashable):
+        waiting = self._waiting.get(key)
+        if waiting is None:
+            return
+        while waiting:
+            blocked = self._admit(waiting[0])
+            if blocked == key:
+                break
+            item = waiting.popleft()
+            if blocked is not None:
+                # Free on this limit but still held back by the other one
+                self._waiting.setdefault(blocked, deque()).append(item)
+        if not waiting:
+            del self._waiting[key]
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            self._space.release()
+            try:
+                await self._run(item[0], item[1], item[3])
+            finally:
+                self._release(item)
+                self.queue.task_done()
+
+    def _record_lag(self, event):
+        api = self.client.api
+        origin_server_ts = getattr(event, "origin_server_ts", None)
+        if api is None or not api.hooks or not origin_server_ts:
+            return
+        lag = time.time() - origin_server_ts / 1000
+        for hook in api.hooks:
+            hook.on_dispatch(event, lag)
+
+    async def _run(self, handler: callable, event, timed: bool = False):
+        if timed:
+            self._record_lag(event)
+        try:
+            await self.client.invoke(handler, event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.failures_by_handler[getattr(handler, "__qualname__", repr(handler))] += 1
+            self.last_failure = e
+            logger.exception("Handler %r failed for %s event", handler, getattr(event, "type", None))
+        else:
+            self.processed += 1
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "workers": len(self.workers),
+            "processed": self.processed,
+            "failures": self.failures,
+            "failures_by_handler": dict(self.failures_by_handler),
+        }
+
+    async def join(self, timeout: Optional[float] = None) -> bool:
+        # False if handlers were still running when the timeout ran out
+        if self._idle is None:
+            return True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
@@ -1,70 +1,41 @@
-from dataclasses import dataclass
-from typing import Optional, List
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any
 
 from .client import Client
 from .room import Room
-from .content import ContentBase
-from .utils import ReactionRelation, MessageRelation
+from .content import ContentBase, LazyContent
 
 
-@dataclass
+@dataclass(slots=True)
 class EventBase:
     client: Client
     content: ContentBase
     type: str
     sender: str
 
+    # Envelope keys the event class has no field for
+    extra: Optional[Dict[str, Any]] = field(default=None, kw_only=True, repr=False, compare=False)
+
     @classmethod
-    def from_dict(cls, client: Client, event_dict: dict):
-        from .content import content_dispatcher
-        if event_dict['type'] == 'm.room.message':
-            content_class = content_dispatcher[event_dict['content']['msgtype']] \
-                if event_dict['content'].get('msgtype') else ContentBase
-        else:
-            content_class = content_dispatcher[event_dict['type']]
-
-        if event_dict['type'] == 'm.reaction':
-            content_dict = {'relation': ReactionRelation(**event_dict['content']['m.relates_to'])}
-        elif event_dict['type'] == 'm.room.bot.options':
-            content_dict = {'options': event_dict['content']}
-        else:
-            content_dict = event_dict['content']
-            if event_dict['type'] == 'm.sticker':
-                content_dict['msgtype'] = 'm.sticker'
-
-        if content_dict.get('m.relates_to'):
-            if content_dict['m.relates_to'].get('m.in_reply_to'):
-                content_dict['relates_to'] = MessageRelation(
-                    event_id=content_dict['m.relates_to']['m.in_reply_to']['event_id']
-                )
-            del content_dict['m.relates_to']
-
-        if content_dict.get('m.new_content'):
-            del content_dict['m.new_content']
-
-        del event_dict['content']
-
-        try:
-            return cls(
-                client=client,
-                content=content_class(**content_dict),
-                **event_dict
-            )
-        except Exception as e:
-            print(content_dict)
-            print(event_dict)
-            raise e
-
-
-@dataclass
+    def from_dict(cls, client: Client, event_dict: dict, room: Room = None):
+        from .decoder import default_decoder
+        return default_decoder.decode(client, event_dict, room, event_class=cls)
+
+
+@dataclass(slots=True)
 class UnsignedData:
     age: int
     redacted_because: Optional[EventBase] = None
     transaction_id: Optional[str] = None
     invite_room_state: Optional[List[EventBase]] = None
+    # Set on state events, the event_id and content of the state they replaced
+    replaces_state: Optional[str] = None
+    prev_content: Optional[Dict[str, Any]] = None
+    prev_sender: Optional[str] = None
+    extra: Optional[Dict[str, Any]] = field(default=None, kw_only=True, repr=False, compare=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class RoomEvent(EventBase):
     event_id: str
     origin_server_ts: int
@@ -72,23 +43,73 @@ class RoomEvent(EventBase):
     room: Room
 
 
-@dataclass
+@dataclass(slots=True)
 class StateEvent(RoomEvent):
     state_key: str
     age: int = None
     prev_content: Optional[EventBase] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class RedactionEvent(RoomEvent):
     redacts: EventBase
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageEvent(RoomEvent):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class PresenceEvent(EventBase):
     pass
+
+
+# The slot the dataclass created for EventBase.content, the lazy classes store the decoded content in it
+_content_slot = EventBase.__dict__["content"]
+
+
+class LazyEvent:
+    # Mixed into the event classes used with Client.lazy_content, the content is decoded on first access
+    __slots__ = ()
+
+    @property
+    def content(self) -> ContentBase:
+        content = _content_slot.__get__(self)
+        if type(content) is LazyContent:
+            content = content.decode()
+            _content_slot.__set__(self, content)
+        return content
+
+    @content.setter
+    def content(self, content):
+        _content_slot.__set__(self, content)
+
+
+class LazyRoomEvent(LazyEvent, RoomEvent):
+    __slots__ = ()
+
+
+class LazyStateEvent(LazyEvent, StateEvent):
+    __slots__ = ()
+
+
+class LazyRedactionEvent(LazyEvent, RedactionEvent):
+    __slots__ = ()
+
+
+class LazyMessageEvent(LazyEvent, MessageEvent):
+    __slots__ = ()
+
+
+class LazyPresenceEvent(LazyEvent, PresenceEvent):
+    __slots__ = ()
+
+
+lazy_event_classes = {
+    RoomEvent: LazyRoomEvent,
+    StateEvent: LazyStateEvent,
+    RedactionEvent: LazyRedactionEvent,
+    MessageEvent: LazyMessageEvent,
+    PresenceEvent: LazyPresenceEvent,
+}
@@ -0,0 +1,59 @@
+from dataclasses import dataclass, field, asdict
+from typing import Optional, List
+
+
+@dataclass
+class EventFilter:
+    limit: Optional[int] = None
+    types: Optional[List[str]] = None
+    not_types: Optional[List[str]] = None
+    senders: Optional[List[str]] = None
+    not_senders: Optional[List[str]] = None
+
+    def to_dict(self) -> dict:
+        return _strip_none(asdict(self))
+
+
+@dataclass
+class RoomEventFilter(EventFilter):
+    rooms: Optional[List[str]] = None
+    not_rooms: Optional[List[str]] = None
+    contains_url: Optional[bool] = None
+    lazy_load_members: Optional[bool] = None
+    include_redundant_members: Optional[bool] = None
+
+
+@dataclass
+class RoomFilter:
+    rooms: Optional[List[str]] = None
+    not_rooms: Optional[List[str]] = None
+    include_leave: Optional[bool] = None
+    ephemeral: RoomEventFilter = field(default_factory=RoomEventFilter)
+    state: RoomEventFilter = field(default_factory=RoomEventFilter)
+    timeline: RoomEventFilter = field(default_factory=RoomEventFilter)
+    account_data: RoomEventFilter = field(default_factory=RoomEventFilter)
+
+
+@dataclass
+class Filter:
+    event_fields: Optional[List[str]] = None
+    event_format: Optional[str] = None
+    presence: EventFilter = field(default_factory=EventFilter)
+    account_data: EventFilter = field(default_factory=EventFilter)
+    room: RoomFilter = field(default_factory=RoomFilter)
+
+    def to_dict(self) -> dict:
+        return _strip_none(asdict(self))
+
+
+def _strip_none(value: dict) -> dict:
+    result = {}
+    for key, item in value.items():
+        if isinstance(item, dict):
+            item = _strip_none(item)
+            if not item:
+                continue
+        elif item is None:
+            continue
+        result[key] = item
+    return result
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import inspect
+import io
+import mimetypes
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Union, Optional, Tuple, AsyncIterator, BinaryIO
+
+from .utils import SingleFlight
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+Source = Union[bytes, bytearray, memoryview, mmap.mmap, BinaryIO, AsyncIterator[bytes]]
+
+
+def parse_mxc(mxc_uri: str) -> Tuple[str, str]:
+    if not mxc_uri.startswith("mxc://"):
+        raise RuntimeWarning(f"{mxc_uri} is not a valid mxc uri")
+    server_name, _, media_id = mxc_uri[6:].partition("/")
+    if not server_name or not media_id:
+        raise RuntimeWarning(f"{mxc_uri} is not a valid mxc uri")
+    return server_name, media_id
+
+
+def guess_mimetype(filename: Optional[str], default: str = "application/octet-stream") -> str:
+    if filename:
+        mimetype, _ = mimetypes.guess_type(filename)
+        if mimetype:
+            return mimetype
+    return default
+
+
+async def write_chunks(chunks: AsyncIterator[bytes], destination) -> int:
+    # destination is a binary file object or anything with an async write method
+    loop = asyncio.get_running_loop()
+    written = 0
+    async for chunk in chunks:
+        if inspect.iscoroutinefunction(destination.write):
+            await destination.write(chunk)
+        else:
+            await loop.run_in_executor(None, destination.write, chunk)
+        written += len(chunk)
+    return written
+
+
+class MediaSource:
+    # Wraps an upload body so every attempt streams it again from the start
+    def __init__(self, source: Source, size: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.size = size if size is not None else self._get_size(source)
+        self._start = source.tell() if self._seekable(source) else None
+        self._opened = False
+
+    @staticmethod
+    def _seekable(source) -> bool:
+        return isinstance(source, io.IOBase) and source.seekable()
+
+    @classmethod
+    def _get_size(cls, source) -> Optional[int]:
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            return len(source)
+        if cls._seekable(source):
+            try:
+                return os.fstat(source.fileno()).st_size - source.tell()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                position = source.tell()
+                size = source.seek(0, io.SEEK_END) - position
+                source.seek(position)
+                return size
+        return None
+
+    def open(self) -> AsyncIterator[bytes]:
+        source = self.source
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            return self._iter_buffer(source)
+        if self._opened and self._start is None:
+            raise RuntimeError("Upload source can not be streamed again")
+        self._opened = True
+        if hasattr(source, "read"):
+            if self._start is not None:
+                source.seek(self._start)
+            return self._iter_file(source)
+        return source.__aiter__()
+
+    async def _iter_buffer(self, buffer) -> AsyncIterator[memoryview]:
+        # Slices of the memoryview share the buffer, nothing is copied
+        view = memoryview(buffer)
+        for offset in range(0, len(view), self.chunk_size):
+            yield view[offset:offset + self.chunk_size]
+
+    async def _iter_file(self, file: BinaryIO) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Disk reads run in the default executor so they don't block the loop
+            chunk = await loop.run_in_executor(None, file.read, self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class MediaCache:
+    # Downloaded media on disk, keyed by a hash of the mxc uri and thumbnail parameters
+    def __init__(self, api, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        # api can be None until the client logs in, the client binds it in run()
+        self.api = api
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._loaded: bool = False
+        # Downloads are keyed by their cache key, the directory scan by None
+        self._flights = SingleFlight()
+
+    async def open(self):
+        # Concurrent callers share the same directory scan
+        if not self._loaded:
+            await self._flights.run(None, self._load)
+
+    async def _load(self):
+        loop = asyncio.get_running_loop()
+        found = await loop.run_in_executor(None, self._scan)
+        # Least recently used first, mtime is bumped on every hit
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.size += size
+        self._loaded = True
+
+    def _scan(self) -> list:
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                for file in os.scandir(entry.path):
+                    if not file.is_file():
+                        continue
+                    if file.name.startswith("."):
+                        # Left over from a download that never finished
+                        os.remove(file.path)
+                        continue
+                    stat = file.stat()
+                    found.append((stat.st_mtime, file.name, stat.st_size))
+        return found
+
+    @staticmethod
+    def cache_key(mxc_uri: str, width: int = None, height: int = None, method: str = "scale") -> str:
+        if width or height:
+            mxc_uri = f"{mxc_uri}#{width or height}x{height or width}-{method}"
+        return hashlib.sha256(mxc_uri.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def __contains__(self, mxc_uri: str) -> bool:
+        return self.cache_key(mxc_uri) in self._entries
+
+    async def get_path(self, mxc_uri: str, width: int = None, height: int = None, method: str = "scale") -> str:
+        if not self._loaded:
+            await self.open()
+        key = self.cache_key(mxc_uri, width, height, method)
+        path = self._path(key)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            try:
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                self._forget(key)
+
+        # Concurrent requests for the same media share one download
+        if key not in self._flights:
+            self.misses += 1
+        return await self._flights.run(key, self._download, key, mxc_uri, width, height, method)
+
+    async def get_mmap(self, mxc_uri: str, width: int = None, height: int = None, method: str = "scale"):
+        path = await self.get_path(mxc_uri, width, height, method)
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b""
+            # The mapping stays valid after the file is closed or evicted
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def _download(self, key: str, mxc_uri: str, width: int, height: int, method: str) -> str:
+        if self.api is None:
+            raise RuntimeError("Media cache has no API, the client is not logged in")
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        loop = asyncio.get_running_loop()
+        os.makedirs(directory, exist_ok=True)
+        # Written to a temporary file first and renamed, readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                size = await self.api.download(mxc_uri, file, width, height, method)
+                await loop.run_in_executor(None, os.fsync, file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._entries[key] = size
+        self.size += size
+        self._evict(key)
+        return path
+
+    def _evict(self, keep: str):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            self._forget(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, key: str):
+        self.size -= self._entries.pop(key, 0)
+
+    def invalidate(self, mxc_uri: str, width: int = None, height: int = None, method: str = "scale"):
+        key = self.cache_key(mxc_uri, width, height, method)
+        if key in self._entries:
+            self._forget(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
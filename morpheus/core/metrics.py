@@ -0,0 +1,193 @@
+import bisect
+from typing import Optional, Dict, List, Tuple
+from urllib.parse import unquote, urlparse
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_SIGILS = {"!": "{room_id}", "#": "{room_alias}", "@": "{user_id}", "$": "{event_id}"}
+
+
+def endpoint_label(path: str) -> str:
+    # Identifiers are replaced with placeholders so every room shares one label per endpoint
+    segments = unquote(urlparse(path).path).split("/")
+    # Drops the leading /_matrix/client/r0 or /_matrix/media/r0
+    if len(segments) > 4 and segments[1] == "_matrix":
+        segments = segments[4:]
+    for i, segment in enumerate(segments):
+        if segment[:1] in _SIGILS:
+            segments[i] = _SIGILS[segment[:1]]
+        elif i >= 2 and segments[i - 2] == "send":
+            segments[i] = "{txn_id}"
+        elif i >= 2 and segments[i - 2] == "state" and segments[0] == "rooms":
+            segments[i] = "{state_key}"
+        elif i >= 1 and segments[i - 1] in ("download", "thumbnail") and i + 1 < len(segments):
+            segments[i] = "{server_name}"
+        elif i >= 2 and segments[i - 2] in ("download", "thumbnail"):
+            segments[i] = "{media_id}"
+    return "/".join(segments)
+
+
+class RequestInfo:
+    __slots__ = (
+        "method",
+        "path",
+        "endpoint",
+        "attempt",
+        "start",
+        "duration",
+        "status",
+        "bytes_out",
+        "bytes_in",
+        "rate_limited",
+        "error",
+    )
+
+    def __init__(self, method: str, path: str):
+        self.method = method.upper()
+        self.path = path
+        self.endpoint = endpoint_label(path)
+        self.attempt = 0
+        self.start = 0.0
+        self.duration = 0.0
+        self.status: Optional[int] = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.rate_limited = False
+        self.error: Optional[BaseException] = None
+
+
+class RequestHook:
+    def pre_request(self, info: RequestInfo):
+        pass
+
+    def post_request(self, info: RequestInfo):
+        pass
+
+    def on_dispatch(self, event, lag: float):
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": dict(zip([*map(str, self.buckets), "+Inf"], self._cumulative())),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+    def _cumulative(self) -> List[int]:
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class EndpointStats:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.latency = Histogram(buckets)
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.statuses: Dict[int, int] = {}
+
+    def snapshot(self) -> dict:
+        return {
+            "latency": self.latency.snapshot(),
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "statuses": dict(self.statuses),
+        }
+
+
+class MetricsRecorder(RequestHook):
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.endpoints: Dict[Tuple[str, str], EndpointStats] = {}
+        self.sync_lag = Histogram(buckets)
+
+    def post_request(self, info: RequestInfo):
+        key = (info.method, info.endpoint)
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = EndpointStats(self.buckets)
+        stats.requests += 1
+        stats.latency.observe(info.duration)
+        if info.attempt > 1:
+            stats.retries += 1
+        if info.rate_limited:
+            stats.rate_limited += 1
+        if info.error is not None or (info.status is not None and info.status >= 400 and not info.rate_limited):
+            stats.errors += 1
+        if info.status is not None:
+            stats.statuses[info.status] = stats.statuses.get(info.status, 0) + 1
+        stats.bytes_in += info.bytes_in
+        stats.bytes_out += info.bytes_out
+
+    def on_dispatch(self, event, lag: float):
+        self.sync_lag.observe(max(lag, 0.0))
+
+    def snapshot(self) -> dict:
+        return {
+            "endpoints": {f"{method} {endpoint}": stats.snapshot() for (method, endpoint), stats in self.endpoints.items()},
+            "sync_lag": self.sync_lag.snapshot(),
+        }
+
+    def to_prometheus(self, namespace: str = "morpheus") -> str:
+        lines = [
+            f"# HELP {namespace}_request_duration_seconds Matrix API request latency",
+            f"# TYPE {namespace}_request_duration_seconds histogram",
+        ]
+        for (method, endpoint), stats in self.endpoints.items():
+            labels = f'method="{method}",endpoint="{endpoint}"'
+            lines.extend(_histogram_lines(f"{namespace}_request_duration_seconds", labels, stats.latency))
+
+        counters = (
+            ("requests_total", "Matrix API requests", "requests"),
+            ("request_retries_total", "Retried Matrix API requests", "retries"),
+            ("request_rate_limited_total", "Matrix API requests rejected with a 429", "rate_limited"),
+            ("request_errors_total", "Failed Matrix API requests", "errors"),
+            ("request_bytes_in_total", "Bytes received from the homeserver", "bytes_in"),
+            ("request_bytes_out_total", "Bytes sent to the homeserver", "bytes_out"),
+        )
+        for name, description, attribute in counters:
+            lines.append(f"# HELP {namespace}_{name} {description}")
+            lines.append(f"# TYPE {namespace}_{name} counter")
+            for (method, endpoint), stats in self.endpoints.items():
+                lines.append(f'{namespace}_{name}{{method="{method}",endpoint="{endpoint}"}} {getattr(stats, attribute)}')
+
+        lines.append(f"# HELP {namespace}_sync_lag_seconds Time between origin_server_ts and the first handler starting")
+        lines.append(f"# TYPE {namespace}_sync_lag_seconds histogram")
+        lines.extend(_histogram_lines(f"{namespace}_sync_lag_seconds", "", self.sync_lag))
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name: str, labels: str, histogram: Histogram) -> List[str]:
+    separator = "," if labels else ""
+    lines = [
+        f'{name}_bucket{{{labels}{separator}le="{bound}"}} {count}'
+        for bound, count in zip([*map(str, histogram.buckets), "+Inf"], histogram._cumulative())
+    ]
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
@@ -0,0 +1,111 @@
+import logging
+import time
+import types
+from typing import Dict, List, Awaitable
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileStats:
+    __slots__ = ("name", "calls", "errors", "wall", "running", "max_step", "blocking")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        # Wall time from start to finish, running is the part spent on the event loop
+        self.wall = 0.0
+        self.running = 0.0
+        self.max_step = 0.0
+        self.blocking = 0
+
+    @property
+    def awaiting(self) -> float:
+        return self.wall - self.running
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "errors": self.errors,
+            "wall": self.wall,
+            "running": self.running,
+            "awaiting": self.awaiting,
+            "mean_wall": self.wall / self.calls if self.calls else 0.0,
+            "max_step": self.max_step,
+            "blocking": self.blocking,
+        }
+
+
+class Profiler:
+    def __init__(self, block_threshold: float = 0.1):
+        # A single step running longer than block_threshold seconds is reported as blocking the loop
+        self.block_threshold = block_threshold
+        self.stats: Dict[str, ProfileStats] = {}
+
+    def get_stats(self, name: str) -> ProfileStats:
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ProfileStats(name)
+        return stats
+
+    async def run(self, name: str, awaitable: Awaitable):
+        return await self._drive(self.get_stats(name), awaitable)
+
+    @types.coroutine
+    def _drive(self, stats: ProfileStats, awaitable: Awaitable):
+        # Steps the wrapped coroutine by hand so the time of every resumption can be measured
+        iterator = awaitable.__await__()
+        clock = time.perf_counter
+        stats.calls += 1
+        started = clock()
+        value = None
+        error = None
+        try:
+            while True:
+                step = clock()
+                try:
+                    if error is None:
+                        yielded = iterator.send(value)
+                    else:
+                        yielded = iterator.throw(error)
+                finally:
+                    self._record_step(stats, clock() - step)
+                try:
+                    value = yield yielded
+                    error = None
+                except BaseException as e:
+                    value = None
+                    error = e
+        except StopIteration as e:
+            return e.value
+        except BaseException:
+            stats.errors += 1
+            raise
+        finally:
+            stats.wall += clock() - started
+
+    def _record_step(self, stats: ProfileStats, duration: float):
+        stats.running += duration
+        if duration > stats.max_step:
+            stats.max_step = duration
+        if duration > self.block_threshold:
+            stats.blocking += 1
+            logger.warning("%s blocked the event loop for %.3fs", stats.name, duration)
+
+    def top(self, n: int = 10, key: str = "running") -> List[dict]:
+        snapshots = [stats.snapshot() for stats in self.stats.values()]
+        snapshots.sort(key=lambda snapshot: snapshot[key], reverse=True)
+        return snapshots[:n]
+
+    def report(self, n: int = 10, key: str = "running") -> str:
+        lines = [f"{'name':40} {'calls':>8} {'wall':>10} {'running':>10} {'awaiting':>10} {'max step':>10} {'blocking':>8}"]
+        for row in self.top(n, key):
+            lines.append(
+                f"{row['name'][:40]:40} {row['calls']:>8} {row['wall']:>10.4f} {row['running']:>10.4f} "
+                f"{row['awaiting']:>10.4f} {row['max_step']:>10.4f} {row['blocking']:>8}"
+            )
+        return "\n".join(lines)
+
+    def reset(self):
+        self.stats.clear()
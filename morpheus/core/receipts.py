@@ -0,0 +1,60 @@
+import asyncio
+from typing import Dict, Optional
+
+
+class ReceiptCoalescer:
+    def __init__(self, client, receipt_type: str = "m.read", flush_interval: Optional[float] = None):
+        from .client import Client
+
+        self.client: Client = client
+        self.receipt_type = receipt_type
+        self.flush_interval = flush_interval
+        self.pending: Dict[str, object] = {}
+        self._last_flush: float = 0.0
+
+    def add(self, event):
+        # Only the newest event per room is worth a receipt, everything before it is implied
+        current = self.pending.get(event.room.id)
+        if current is None or current.origin_server_ts <= event.origin_server_ts:
+            self.pending[event.room.id] = event
+
+    def due(self) -> bool:
+        if not self.pending:
+            return False
+        if not self.flush_interval:
+            return True
+        return self.client.loop.time() - self._last_flush >= self.flush_interval
+
+    async def maybe_flush(self):
+        if self.due():
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        events = list(self.pending.values())
+        self.pending = {}
+        self._last_flush = self.client.loop.time()
+
+        results = await asyncio.gather(
+            *(self.client.mark_event_read(event, self.receipt_type) for event in events),
+            return_exceptions=True,
+        )
+        error = None
+        for event, result in zip(events, results):
+            if isinstance(result, RuntimeError):
+                # Not an event a receipt can be sent for
+                continue
+            if isinstance(result, BaseException):
+                error = error or result
+                # Sent again with the next flush, unless a newer event of the room arrived in the meantime
+                current = self.pending.get(event.room.id)
+                if current is None or current.origin_server_ts < event.origin_server_ts:
+                    self.pending[event.room.id] = event
+                continue
+            receipts = event.room.read_receipts
+            current = receipts.get(self.client.user_id)
+            if current is None or current[1] < event.origin_server_ts:
+                receipts[self.client.user_id] = (event.event_id, event.origin_server_ts)
+        if error is not None:
+            raise error
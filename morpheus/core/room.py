@@ -1,4 +1,6 @@
-from typing import List, Optional, Dict, Tuple
+import asyncio
+import sys
+from typing import List, Optional, Dict, Tuple, AsyncIterator, TYPE_CHECKING
 from datetime import datetime, timedelta
 from collections import deque
 
@@ -13,8 +15,40 @@ from .content import (
     MRoomNameContent,
     MRoomRelatedGroupsContent,
     MRoomTopicContent,
+    MRoomMemberContent,
 )
-from .utils import PreviousRoom, DequeDict
+from .utils import PreviousRoom, SingleFlight
+
+if TYPE_CHECKING:
+    # events imports this module, so the names are only needed for the annotations
+    from .events import StateEvent, RoomEvent
+
+TRACKED_STATE_TYPES = (
+    "m.room.topic",
+    "m.room.name",
+    "m.room.related_groups",
+    "m.room.join_rules",
+    "m.room.history_visibility",
+    "m.room.create",
+    "m.room.canonical_alias",
+    "m.room.aliases",
+    "m.room.bot.options",
+    "m.room.power_levels",
+    "m.room.member",
+)
+
+
+class RoomMember:
+    __slots__ = ("user_id", "membership", "displayname", "avatar_url")
+
+    def __init__(self, user_id: str, membership: str, displayname: Optional[str] = None, avatar_url: Optional[str] = None):
+        self.user_id = sys.intern(user_id)
+        self.membership = sys.intern(membership)
+        self.displayname = displayname
+        self.avatar_url = avatar_url
+
+    def __repr__(self):
+        return f"RoomMember(user_id={self.user_id!r}, membership={self.membership!r}, displayname={self.displayname!r})"
 
 
 class Room:
@@ -34,6 +68,7 @@ class Room:
         self.history_visibility: Optional[str] = None
         self.avatar_url: str = ""
         self.canonical_alias: Optional[str] = None
+        self.alt_aliases: List[str] = []
         self.power_levels: Optional[MRoomPowerLevelsContent] = None
         self.bot_options: Optional[Dict[str, dict]] = None
         self.federated: bool = True
@@ -42,7 +77,18 @@ class Room:
         self.joined_member_count: Optional[int] = None
         self.invited_member_count: Optional[int] = None
         self.read_receipts: Dict[str, Tuple[str, int]] = {}
-        self.message_cache = DequeDict(max=1000)
+        self.members: Dict[str, RoomMember] = {}
+        self.members_loaded: bool = False
+        # Concurrent callers share the same members or state request
+        self._fetches = SingleFlight()
+        # Current state keyed by (event type, state key)
+        self.state: Dict[Tuple[str, str], "StateEvent"] = {}
+        self.state_gaps: int = 0
+        # Set when the state is fetched again, it already covers the rest of the sync batch being processed
+        self.resynced: bool = False
+        # Pagination token for the events before the last synced timeline
+        self.prev_batch: Optional[str] = None
+        self.message_cache = client.message_cache.room(room_id) if client.message_cache is not None else None
 
     def update_read_receipts(self, receipts: Dict[str, Dict[str, Dict[str, Dict[str, int]]]]):
         for event_id, receipt in receipts.items():
@@ -50,19 +96,131 @@ class Room:
             for user, time in users.items():
                 self.read_receipts[user] = (event_id, time['ts'])
 
-    async def update_state(self, state_event=None):
+    def update_summary(self, summary: dict):
+        if "m.heroes" in summary:
+            self.heroes = summary["m.heroes"]
+        if "m.joined_member_count" in summary:
+            self.joined_member_count = summary["m.joined_member_count"]
+        if "m.invited_member_count" in summary:
+            self.invited_member_count = summary["m.invited_member_count"]
+
+    def _update_member(self, user_id: str, content: MRoomMemberContent):
+        if content.membership in ("join", "invite"):
+            member = self.members.get(user_id)
+            if member:
+                member.membership = sys.intern(content.membership)
+                member.displayname = content.displayname
+                member.avatar_url = content.avatar_url
+            else:
+                self.members[sys.intern(user_id)] = RoomMember(
+                    user_id, content.membership, content.displayname, content.avatar_url
+                )
+        else:
+            self.members.pop(user_id, None)
+
+    async def fetch_members(self):
+        await self._fetches.run("members", self._fetch_members)
+
+    async def _fetch_members(self):
+        path = self.client.api.build_url(f"rooms/{self.id}/joined_members")
+        resp = await self.client.api.send("GET", path)
+        if resp.get("errcode"):
+            raise RuntimeWarning(resp)
+        joined = resp.get("joined", {})
+        for user_id in [user_id for user_id, member in self.members.items() if member.membership == "join"]:
+            if user_id not in joined:
+                del self.members[user_id]
+        for user_id, profile in joined.items():
+            member = self.members.get(user_id)
+            if member:
+                member.membership = "join"
+                member.displayname = profile.get("display_name")
+                member.avatar_url = profile.get("avatar_url")
+            else:
+                self.members[sys.intern(user_id)] = RoomMember(
+                    user_id, "join", profile.get("display_name"), profile.get("avatar_url")
+                )
+        self.members_loaded = True
+
+    async def get_member(self, user_id: str) -> Optional[RoomMember]:
+        member = self.members.get(user_id)
+        if member is None and not self.members_loaded:
+            await self.fetch_members()
+            member = self.members.get(user_id)
+        return member
+
+    async def get_display_name(self, user_id: str) -> str:
+        member = await self.get_member(user_id)
+        if member and member.displayname:
+            return member.displayname
+        return user_id
+
+    def get_power_level(self, user_id: str) -> int:
+        if not self.power_levels:
+            return 100 if user_id == self.creator else 0
+        return self.power_levels.users.get(user_id, self.power_levels.users_default)
+
+    def get_state(self, event_type: str, state_key: str = "") -> Optional["StateEvent"]:
+        return self.state.get((event_type, state_key))
+
+    def get_state_content(self, event_type: str, state_key: str = ""):
+        event = self.state.get((event_type, state_key))
+        return event.content if event is not None else None
+
+    async def update_state(self, state_event=None, check_gap: bool = True):
         from .events import StateEvent
 
-        if not state_event or state_event.room != self:
-            path = self.client.api.build_url(f"rooms/{self.id}/state")
-            state_events = await self.client.api.send("GET", path)
-            for state_event in state_events:
-                self._update_state(self.client.process_event(state_event))
+        if not state_event:
+            await self.fetch_state()
+            return
+        if state_event.room is not None and state_event.room != self:
+            await state_event.room.update_state(state_event, check_gap)
+            return
+        if not isinstance(state_event, StateEvent):
+            return
+
+        key = (state_event.type, state_event.state_key)
+        if check_gap and self._is_gap(key, state_event):
+            # The previous state event was never seen so the local copy can't be trusted any more
+            self.state_gaps += 1
+            await self.fetch_state()
+            return
+        self._apply_state(key, state_event)
+
+    def _is_gap(self, key: Tuple[str, str], state_event) -> bool:
+        current = self.state.get(key)
+        if current is None or current.event_id == state_event.event_id:
+            return False
+        replaces_state = state_event.unsigned.replaces_state if state_event.unsigned else None
+        return replaces_state is not None and replaces_state != current.event_id
+
+    def _apply_state(self, key: Tuple[str, str], state_event):
+        self.state[key] = state_event
+        if state_event.type == "m.room.member":
+            self._update_member(state_event.state_key, state_event.content)
         else:
-            if not isinstance(state_event, StateEvent) or state_event.type == "m.room.member":
-                return
             self._update_state(state_event)
 
+    async def fetch_state(self):
+        await self._fetches.run("state", self._fetch_state)
+
+    async def _fetch_state(self):
+        path = self.client.api.build_url(f"rooms/{self.id}/state")
+        state_events = await self.client.api.send("GET", path)
+        if isinstance(state_events, dict) and state_events.get("errcode"):
+            raise RuntimeWarning(state_events)
+        # Malformed events are dropped before anything is stored
+        decoded = [(event_dict, self.client.decode_event(event_dict, self)) for event_dict in state_events]
+        decoded = [(event_dict, state_event) for event_dict, state_event in decoded if state_event is not None]
+        if self.client.store:
+            self.client.replace_state(self.id, [event_dict for event_dict, _ in decoded])
+        self.resynced = True
+        self.state = {}
+        self.members = {}
+        for _, state_event in decoded:
+            self._apply_state((state_event.type, state_event.state_key), state_event)
+        self.members_loaded = True
+
     def _update_state(self, event):
         content = event.content
         if isinstance(content, MRoomTopicContent):
@@ -81,24 +239,84 @@ class Room:
             self.version = content.room_version
             self.predecessor = content.predecessor
         elif isinstance(content, MRoomCanonicalAliasContent):
+            alt_aliases = content.alt_aliases or []
+            self._update_alias_cache([self.canonical_alias, *self.alt_aliases], [content.alias, *alt_aliases])
             self.canonical_alias = content.alias
+            self.alt_aliases = alt_aliases
         elif isinstance(content, MRoomAliasesContent):
+            self._update_alias_cache(self.aliases or [], content.aliases or [])
             self.aliases = content.aliases
         elif isinstance(content, MRoomBotOptionsContent):
             self.bot_options = content.options
         elif isinstance(content, MRoomPowerLevelsContent):
             self.power_levels = content
 
+    def _update_alias_cache(self, old_aliases: List[Optional[str]], new_aliases: List[Optional[str]]):
+        if not self.client.api:
+            return
+        cache = self.client.api.alias_cache
+        for alias in old_aliases:
+            if alias and alias not in new_aliases:
+                cache.invalidate(alias)
+        for alias in new_aliases:
+            if alias:
+                cache.put(alias, self.id)
+
     async def send_text(self, body: str, formatted_body: str = None, format_type: str = 'org.matrix.custom.html'):
         await self.client.send_text(self, body, formatted_body, format_type)
 
+    async def history(
+        self,
+        direction: str = "b",
+        limit: Optional[int] = None,
+        page_size: int = 100,
+        start: Optional[str] = None,
+        room_filter=None,
+    ) -> AsyncIterator["RoomEvent"]:
+        # Backwards pagination starts from the last sync unless a token is given
+        token = start if start is not None or direction != "b" else self.prev_batch
+        api = self.client.api
+        fetch = asyncio.ensure_future(api.get_messages(self.id, token, direction, page_size, room_filter=room_filter))
+        count = 0
+        try:
+            while fetch is not None:
+                resp = await fetch
+                fetch = None
+                chunk = resp.get("chunk") or []
+                end = resp.get("end")
+                # The next page is requested while the caller works through this one
+                if chunk and end and end != token and (limit is None or count + len(chunk) < limit):
+                    fetch = asyncio.ensure_future(
+                        api.get_messages(self.id, end, direction, page_size, room_filter=room_filter)
+                    )
+                token = end
+                for event_dict in chunk:
+                    event = self.client.decode_event(event_dict, self)
+                    if event is None:
+                        continue
+                    yield event
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+        finally:
+            if fetch is not None:
+                fetch.cancel()
+
+    async def send_image(self, source, filename: str, **kwargs):
+        return await self.client.send_image(self, source, filename, **kwargs)
+
+    async def send_file(self, source, filename: str, **kwargs):
+        return await self.client.send_file(self, source, filename, **kwargs)
+
+    async def send_video(self, source, filename: str, **kwargs):
+        return await self.client.send_video(self, source, filename, **kwargs)
+
+    async def send_audio(self, source, filename: str, **kwargs):
+        return await self.client.send_audio(self, source, filename, **kwargs)
+
     # TODO send_emote
     # TODO send_notice
-    # TODO send_image
-    # TODO send_file
-    # TODO send_audio
     # TODO send_location
-    # TODO send_video
 
     def __eq__(self, other):
         return other.__class__ == self.__class__ and other.id == self.id
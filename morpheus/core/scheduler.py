@@ -0,0 +1,182 @@
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import time
+from typing import Optional, Dict, List, Tuple
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        # A rate of 0 or less disables the bucket
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens: float = self.burst
+        self.updated: float = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class SharedTokenBucket:
+    # A TokenBucket kept in shared memory so several processes draw from one limit
+    def __init__(self, rate: float, burst: int, context=None):
+        context = context or multiprocessing
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # tokens, last refill, monotonic time is system wide so it is comparable between processes
+        self._state = context.Array("d", [self.burst, time.monotonic()])
+
+    def _refill(self, state, now: float):
+        if now > state[1]:
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+
+    def delay(self, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._state.get_lock():
+            self._refill(self._state, now)
+            tokens = self._state[0]
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate > 0:
+            with self._state.get_lock():
+                self._refill(self._state, now)
+                self._state[0] -= 1
+
+    def idle(self, now: float) -> bool:
+        with self._state.get_lock():
+            self._refill(self._state, now)
+            return self._state[0] >= self.burst
+
+
+class SendScheduler:
+    def __init__(
+        self,
+        rate: float = 0.0,
+        burst: int = 10,
+        room_rate: float = 0.0,
+        room_burst: int = 5,
+        bucket: Optional[TokenBucket] = None,
+    ):
+        # A bucket can be passed in to share the global limit, see SharedTokenBucket
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.room_buckets: Dict[str, TokenBucket] = {}
+        self.resume_at: float = 0.0
+        self.waiting: List[Tuple[int, int, Optional[str], asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.waiting)
+
+    def _room_bucket(self, room_id: Optional[str]) -> Optional[TokenBucket]:
+        if room_id is None or self.room_rate <= 0:
+            return None
+        bucket = self.room_buckets.get(room_id)
+        if bucket is None:
+            if len(self.room_buckets) >= 1024:
+                now = time.monotonic()
+                for key in [key for key, value in self.room_buckets.items() if value.idle(now)]:
+                    del self.room_buckets[key]
+            bucket = self.room_buckets[room_id] = TokenBucket(self.room_rate, self.room_burst)
+        return bucket
+
+    def _try_grant(self, room_id: Optional[str], now: float) -> float:
+        wait = self.bucket.delay(now)
+        room_bucket = self._room_bucket(room_id)
+        if room_bucket:
+            wait = max(wait, room_bucket.delay(now))
+        if wait <= 0:
+            self.bucket.consume(now)
+            if room_bucket:
+                room_bucket.consume(now)
+        return wait
+
+    async def acquire(self, room_id: Optional[str] = None, priority: int = PRIORITY_NORMAL):
+        now = time.monotonic()
+        if not self.waiting and now >= self.resume_at and self._try_grant(room_id, now) <= 0:
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self._counter), room_id, future))
+        self._wake()
+        await future
+
+    def backoff(self, retry_after_ms: float):
+        # A 429 pauses every queued request, not only the one that was rejected
+        self.resume_at = max(self.resume_at, time.monotonic() + retry_after_ms / 1000)
+        self._wake()
+
+    def _wake(self):
+        if self._pump is None or self._pump.done():
+            self._wakeup = asyncio.Event()
+            self._pump = asyncio.get_running_loop().create_task(self._run())
+        else:
+            self._wakeup.set()
+
+    def _grant(self, now: float) -> Optional[float]:
+        next_wait = None
+        remaining = []
+        for entry in sorted(self.waiting):
+            future = entry[3]
+            if future.done():
+                continue
+            # With the global bucket empty nobody can be granted, otherwise a throttled room is skipped
+            wait = self.bucket.delay(now)
+            if wait <= 0:
+                wait = self._try_grant(entry[2], now)
+            if wait <= 0:
+                future.set_result(None)
+            else:
+                remaining.append(entry)
+                next_wait = wait if next_wait is None else min(next_wait, wait)
+        heapq.heapify(remaining)
+        self.waiting = remaining
+        return next_wait
+
+    async def _run(self):
+        while self.waiting:
+            now = time.monotonic()
+            if now < self.resume_at:
+                delay = self.resume_at - now
+            else:
+                delay = self._grant(now)
+                if not self.waiting:
+                    break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import zlib
+from typing import Optional, Dict, List, Set, Callable
+
+from .api import API
+from .client import Client
+from .scheduler import SharedTokenBucket
+from .store import StoreBase
+
+logger = logging.getLogger(__name__)
+
+_STOP = b""
+
+
+def shard_for(room_id: str, shards: int) -> int:
+    # crc32 is stable between processes and runs, unlike hash()
+    return zlib.crc32(room_id.encode()) % shards
+
+
+def split_sync(resp: dict, shards: int) -> List[Optional[dict]]:
+    # Rooms go to their shard, everything that isn't a room goes to shard 0
+    slices: List[Optional[dict]] = [None] * shards
+
+    def get_slice(index: int) -> dict:
+        if slices[index] is None:
+            slices[index] = {
+                "next_batch": resp["next_batch"],
+                "rooms": {"join": {}, "invite": {}, "leave": {}},
+            }
+        return slices[index]
+
+    for key, value in resp.items():
+        if key == "rooms":
+            for membership in ("join", "invite", "leave"):
+                for room_id, data in (value.get(membership) or {}).items():
+                    get_slice(shard_for(room_id, shards))["rooms"][membership][room_id] = data
+        elif key != "next_batch":
+            get_slice(0)[key] = value
+    return slices
+
+
+class _ShardStore(StoreBase):
+    # Replaces the store in a worker, the parent owns the real store and saves what every shard recorded
+    def __init__(self):
+        self.rooms: Dict[str, List[dict]] = {}
+        self.replace: Set[str] = set()
+
+    async def load(self):
+        return None, {}
+
+    def save(self, next_batch: str, rooms: Dict[str, List[dict]], replace: Optional[Set[str]] = None):
+        self.rooms = rooms
+        self.replace = set(replace or ())
+
+    def take(self) -> dict:
+        saved = {"rooms": self.rooms, "replace": sorted(self.replace)}
+        self.rooms = {}
+        self.replace = set()
+        return saved
+
+
+class ShardedRunner:
+    def __init__(
+        self,
+        factory: Callable[[], Client],
+        shards: Optional[int] = None,
+        send_rate: float = 0.0,
+        send_burst: int = 10,
+        start_method: str = "spawn",
+    ):
+        # factory builds a fully configured Client or Bot, it is called once here and once in every worker, always
+        # inside a running event loop, so with the spawn start method it has to be a module level function.
+        # The store of the client is only used here, workers send back the state they recorded instead
+        self.factory = factory
+        self.shards = shards or os.cpu_count() or 1
+        self.send_rate = send_rate
+        self.send_burst = send_burst
+        self.context = multiprocessing.get_context(start_method)
+        self.running: bool = False
+        self.sync_since: Optional[str] = None
+        self.processes: List[multiprocessing.Process] = []
+        self.connections = []
+
+    def run(self, user_id: str = None, password: str = None, token: str = None):
+        asyncio.run(self.start(user_id, password, token))
+
+    async def start(self, user_id: str = None, password: str = None, token: str = None):
+        if not password and not token:
+            raise RuntimeError("Either the password or a token is required")
+        client = self.factory()
+        api = API(
+            base_url=client.homeserver,
+            user_id=user_id,
+            password=password,
+            token=token,
+            config=client.api_config,
+        )
+        resp = await api.login()
+        if resp.get("errcode"):
+            raise RuntimeError(resp)
+        client.api = api
+        client.user_id = api.user_id
+        if client.sync_filter is None and client.sync_auto_filter:
+            client.sync_filter = await api.create_filter(client.build_sync_filter().to_dict())
+
+        store = client.store
+        loop = asyncio.get_running_loop()
+        try:
+            rooms = {}
+            if store:
+                await store.open()
+                next_batch, rooms = await store.load()
+                if next_batch and not self.sync_since:
+                    self.sync_since = next_batch
+            shard_rooms = [{} for _ in range(self.shards)]
+            for room_id, events in rooms.items():
+                shard_rooms[shard_for(room_id, self.shards)][room_id] = events
+
+            bucket = SharedTokenBucket(self.send_rate, self.send_burst, self.context) if self.send_rate > 0 else None
+            for index in range(self.shards):
+                parent, child = self.context.Pipe()
+                process = self.context.Process(
+                    target=_worker_main,
+                    args=(
+                        self.factory, index, api.base_url, api.user_id, api.access_token, api.device_id, bucket, child
+                    ),
+                    name=f"morpheus-shard-{index}",
+                    daemon=True,
+                )
+                process.start()
+                child.close()
+                self.processes.append(process)
+                self.connections.append(parent)
+                # The first message to a worker is the stored state of its rooms
+                await loop.run_in_executor(None, parent.send_bytes, api.codec.dumps(shard_rooms[index]))
+
+            self.running = True
+            while self.running:
+                resp = await client.fetch_sync(self.sync_since)
+                slices = split_sync(resp, self.shards)
+                pending = []
+                for index, shard_slice in enumerate(slices):
+                    if shard_slice is None:
+                        continue
+                    connection = self.connections[index]
+                    await loop.run_in_executor(None, connection.send_bytes, api.codec.dumps(shard_slice))
+                    pending.append(loop.run_in_executor(None, connection.recv_bytes))
+                # The next sync waits for every shard, which keeps events in order and bounds the backlog
+                try:
+                    replies = await asyncio.gather(*pending)
+                except EOFError:
+                    raise RuntimeError("A shard worker exited unexpectedly")
+                self.sync_since = resp["next_batch"]
+                if store:
+                    # Every room belongs to one shard, so the recorded state never overlaps
+                    rooms, replace = {}, set()
+                    for reply in replies:
+                        saved = api.codec.loads(reply)
+                        rooms.update(saved["rooms"])
+                        replace.update(saved["replace"])
+                    store.save(self.sync_since, rooms, replace)
+                if client.sync_delay:
+                    await asyncio.sleep(client.sync_delay)
+        finally:
+            self.running = False
+            await self.stop()
+            if store:
+                await store.close()
+            await api.close()
+
+    async def stop(self):
+        loop = asyncio.get_running_loop()
+        for connection in self.connections:
+            try:
+                connection.send_bytes(_STOP)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+
+
+def _worker_main(factory, index, base_url, user_id, access_token, device_id, bucket, connection):
+    asyncio.run(_worker(factory, index, base_url, user_id, access_token, device_id, bucket, connection))
+
+
+async def _worker(factory, index, base_url, user_id, access_token, device_id, bucket, connection):
+    loop = asyncio.get_running_loop()
+    client = factory()
+    client.loop = loop
+    client.user_id = user_id
+    client.store = _ShardStore()
+    # Workers share the session of the parent, they never log in or out themselves
+    client.api = API(base_url=base_url, user_id=user_id, config=client.api_config)
+    client.api.access_token = access_token
+    client.api.device_id = device_id
+    if bucket is not None:
+        client.api.scheduler.bucket = bucket
+    if client.media_cache:
+        client.media_cache.api = client.api
+    client.running = True
+    try:
+        data = await loop.run_in_executor(None, connection.recv_bytes)
+        if data != _STOP:
+            await client.load_state(client.api.codec.loads(data))
+        while data != _STOP:
+            data = await loop.run_in_executor(None, connection.recv_bytes)
+            if data == _STOP:
+                break
+            try:
+                await client.process_sync(client.api.codec.loads(data))
+            except Exception:
+                logger.exception("Shard %d failed to process a sync batch", index)
+            # The acknowledgement carries the state recorded for the batch
+            connection.send_bytes(client.api.codec.dumps(client.store.take()))
+    except EOFError:
+        pass
+    finally:
+        client.running = False
+        await client.dispatcher.join(client.shutdown_timeout)
+        await client.flush_receipts()
+        await client.dispatcher.close()
+        await client.api.close()
+        connection.close()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple, Set
+
+logger = logging.getLogger(__name__)
+
+
+class StoreBase(ABC):
+    async def open(self):
+        pass
+
+    @abstractmethod
+    async def load(self) -> Tuple[Optional[str], Dict[str, List[dict]]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, next_batch: str, rooms: Dict[str, List[dict]], replace: Optional[Set[str]] = None):
+        # Rooms in replace drop everything stored for them before their events are written
+        raise NotImplementedError
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        await self.flush()
+
+
+class MemoryStore(StoreBase):
+    def __init__(self):
+        self.next_batch: Optional[str] = None
+        self.rooms: Dict[str, Dict[Tuple[str, str], dict]] = {}
+
+    async def load(self) -> Tuple[Optional[str], Dict[str, List[dict]]]:
+        return self.next_batch, {room_id: list(state.values()) for room_id, state in self.rooms.items()}
+
+    def save(self, next_batch: str, rooms: Dict[str, List[dict]], replace: Optional[Set[str]] = None):
+        for room_id in replace or ():
+            self.rooms[room_id] = {}
+        for room_id, events in rooms.items():
+            state = self.rooms.setdefault(room_id, {})
+            for event in events:
+                state[(event["type"], event["state_key"])] = event
+        self.next_batch = next_batch
+
+
+class SQLiteStore(StoreBase):
+    def __init__(self, path: str):
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+        # A single worker keeps the writes in the order the syncs happened
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="morpheus-store")
+        self._pending: Optional[asyncio.Future] = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sync (id INTEGER PRIMARY KEY CHECK (id = 0), next_batch TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS room_state ("
+            "room_id TEXT NOT NULL, type TEXT NOT NULL, state_key TEXT NOT NULL, event TEXT NOT NULL, "
+            "PRIMARY KEY (room_id, type, state_key))"
+        )
+        self.connection.commit()
+
+    async def load(self) -> Tuple[Optional[str], Dict[str, List[dict]]]:
+        return await self._run(self._load)
+
+    def _load(self) -> Tuple[Optional[str], Dict[str, List[dict]]]:
+        row = self.connection.execute("SELECT next_batch FROM sync WHERE id = 0").fetchone()
+        rooms: Dict[str, List[dict]] = {}
+        for room_id, event in self.connection.execute("SELECT room_id, event FROM room_state"):
+            rooms.setdefault(room_id, []).append(json.loads(event))
+        return row[0] if row else None, rooms
+
+    def save(self, next_batch: str, rooms: Dict[str, List[dict]], replace: Optional[Set[str]] = None):
+        loop = asyncio.get_running_loop()
+        self._pending = loop.run_in_executor(self.executor, self._save, next_batch, rooms, replace)
+        self._pending.add_done_callback(self._log_error)
+
+    def _save(self, next_batch: str, rooms: Dict[str, List[dict]], replace: Optional[Set[str]] = None):
+        rows = [
+            (room_id, event["type"], event["state_key"], json.dumps(event))
+            for room_id, events in rooms.items()
+            for event in events
+        ]
+        # Room state and the sync token are committed together so a restart never resumes past missing state
+        with self.connection:
+            if replace:
+                rooms_to_replace = [(room_id,) for room_id in replace]
+                self.connection.executemany("DELETE FROM room_state WHERE room_id = ?", rooms_to_replace)
+            if rows:
+                self.connection.executemany("INSERT OR REPLACE INTO room_state VALUES (?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO sync VALUES (0, ?)", (next_batch,))
+
+    @staticmethod
+    def _log_error(future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            logger.error("Failed to write sync checkpoint", exc_info=future.exception())
+
+    async def flush(self):
+        if self._pending:
+            await asyncio.wait([self._pending])
+            self._pending = None
+
+    async def close(self):
+        await self.flush()
+        if self.connection:
+            await self._run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown(wait=False)
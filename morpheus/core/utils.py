@@ -1,10 +1,12 @@
+import asyncio
+import itertools
 from dataclasses import dataclass
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Iterable, Awaitable, AsyncIterator, Any, Callable, Hashable
 from inspect import isawaitable
 from collections import OrderedDict
 
 
-@dataclass
+@dataclass(slots=True)
 class JSONWebKey:
     key_opts: List[str]
     k: str
@@ -13,7 +15,7 @@ class JSONWebKey:
     kty: str = "oct"
 
 
-@dataclass
+@dataclass(slots=True)
 class EncryptedFile:
     url: str
     key: JSONWebKey
@@ -22,7 +24,7 @@ class EncryptedFile:
     v: str = "v2"
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageInfoBase:
     h: int
     w: int
@@ -30,14 +32,14 @@ class ImageInfoBase:
     size: int
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageInfo(ImageInfoBase):
     thumbnail_info: ImageInfoBase
     thumbnail_url: Optional[str] = None
     thumbnail_file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class FileInfo:
     mimetype: str
     size: int
@@ -46,21 +48,21 @@ class FileInfo:
     thumbnail_file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class AudioInfo:
     duration: int
     mimetype: str
     size: int
 
 
-@dataclass
+@dataclass(slots=True)
 class LocationInfo:
     thumbnail_info: ImageInfoBase
     thumbnail_url: Optional[str] = None
     thumbnail_file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class VideoInfo(ImageInfoBase):
     duration: int
     thumbnail_info: ImageInfoBase
@@ -68,33 +70,33 @@ class VideoInfo(ImageInfoBase):
     thumbnail_file: Optional[EncryptedFile] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class PreviousRoom:
     room_id: str
     event_id: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Signed:
     mxid: str
     signatures: Dict[str, Dict[str, str]]
     token: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Invite:
     display_name: str
     signed: Signed
 
 
-@dataclass
+@dataclass(slots=True)
 class ReactionRelation:
     rel_type: str
     event_id: str
     key: str
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageRelation:
     event_id: str
 
@@ -107,6 +109,40 @@ async def maybe_coroutine(func, *args, **kwargs):
         return f
 
 
+async def as_completed_bounded(aws: Iterable[Awaitable], limit: int) -> AsyncIterator[Any]:
+    # Like asyncio.as_completed but only keeps limit awaitables running, the iterable is consumed lazily
+    iterator = iter(aws)
+    pending = {asyncio.ensure_future(aw) for aw in itertools.islice(iterator, max(limit, 1))}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for aw in itertools.islice(iterator, len(done)):
+                pending.add(asyncio.ensure_future(aw))
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share the call that is already running instead of starting another one
+    def __init__(self):
+        self._running: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._running
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable], *args) -> Any:
+        future = self._running.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self._running[key] = future
+            future.add_done_callback(lambda _: self._running.pop(key, None))
+        # A cancelled caller leaves the call running for the others
+        return await asyncio.shield(future)
+
+
 def notification_power_levels_default_factory():
     return {'room': 50}
 
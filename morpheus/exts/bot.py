@@ -1,5 +1,5 @@
 import asyncio
-from typing import Union, Optional, Dict, List
+from typing import Union, Optional, Dict, List, Tuple
 from inspect import isawaitable
 from argparse import ArgumentParser
 
@@ -10,6 +10,7 @@ from morpheus.core.events import RoomEvent
 from morpheus.core.content import MessageContentBase
 from .context import Context
 from .command import Command
+from .router import CommandRouter
 
 
 class Bot(Client):
@@ -21,15 +22,29 @@ class Bot(Client):
         self.loop = asyncio.get_event_loop()
         super(Bot, self).__init__(prefix=prefix, homeserver=homeserver)
         self.commands: Dict[str, Command] = {}
+        self.router = CommandRouter()
 
     def run(self, user_id: str = None, password: str = None, token: str = None, loop: Optional[asyncio.AbstractEventLoop] = None):
         loop = loop or self.loop or asyncio.get_event_loop()
         loop.run_until_complete(super(Bot, self).run(user_id, password, token, loop=loop))
 
+    def get_handled_event_types(self) -> set:
+        handled = super(Bot, self).get_handled_event_types()
+        if self.commands:
+            handled.add('m.room.message')
+        return handled
+
     async def get_context(self, event: RoomEvent):
         if not isinstance(event.content, MessageContentBase):
             return None
 
+        for prefix in await self.get_prefixes(event):
+            ctx = self._get_context(event, prefix)
+            if ctx:
+                return ctx
+        return None
+
+    async def get_prefixes(self, event: RoomEvent) -> Tuple[str, ...]:
         if callable(self.prefix):
             prefix = await maybe_coroutine(self.prefix, event)
         elif isinstance(self.prefix, (str, list, tuple)):
@@ -38,18 +53,11 @@ class Bot(Client):
             raise RuntimeError('Prefix must be a string, list of strings or callable')
 
         if isinstance(prefix, str):
-            return self._get_context(event, prefix)
+            return (prefix,)
         elif isinstance(prefix, (list, tuple)):
-            prefixes = tuple(prefix)
-            for prefix in prefixes:
-                try:
-                    ctx = self._get_context(event, prefix)
-                    if ctx:
-                        return ctx
-                except TypeError:
-                    raise RuntimeError('Prefix must be a string or list of strings')
-            else:
-                return None
+            if any(not isinstance(p, str) for p in prefix):
+                raise RuntimeError('Prefix must be a string or list of strings')
+            return tuple(prefix)
         else:
             raise RuntimeError('Prefix must be a string or list of strings')
 
@@ -61,7 +69,7 @@ class Bot(Client):
         raw_body = event.content.body
         if not raw_body.startswith(prefix):
             return None
-        raw_body = raw_body.lstrip(prefix)
+        raw_body = raw_body[len(prefix):]
         body_list = raw_body.split(' ', 1)
         called_with = body_list[0]
         body = body_list[1] if len(body_list) > 1 else None
@@ -71,14 +79,19 @@ class Bot(Client):
         if not event.content.msgtype == 'm.text':
             return
 
-        ctx = await self.get_context(event)
-        if not ctx:
+        # One anchored match finds both the prefix and the command
+        match = self.router.match(event.content.body, await self.get_prefixes(event))
+        if not match:
             return
 
-        command = self.commands.get(ctx.called_with)
-        if not command:
-            return
-        await command.invoke(ctx, ctx.body.split(' ') if ctx.body else None)
+        prefix, called_with, body = match
+        ctx = Context.get_context(event, prefix, called_with, body)
+        command = self.commands[called_with]
+        args_list = ctx.body.split(' ') if ctx.body else None
+        if self.profiler is None:
+            await command.invoke(ctx, args_list)
+        else:
+            await self.profiler.run(f'command {command.name}', command.invoke(ctx, args_list))
 
     def listener(self, name=None):
         def decorator(func):
@@ -101,10 +114,12 @@ class Bot(Client):
         if name in self.commands or any([alias in self.commands for alias in aliases]):
             raise RuntimeWarning(f'Command {name} has already been registered')
 
-        command = Command(func)
+        command = Command(func, name=name)
         self.commands[name] = command
+        self.router.add(name)
         for alias in aliases:
             self.commands[alias] = command
+            self.router.add(alias)
 
     def command(self, name: Optional[str] = None, aliases: Optional[list] = None):
         def decorator(func):
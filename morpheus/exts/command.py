@@ -1,10 +1,10 @@
 import inspect
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from typing import Optional
 
 
 class Command:
-    def __init__(self, function: callable, extension: str = None):
+    def __init__(self, function: callable, extension: str = None, name: str = None):
         if not callable(function):
             raise RuntimeError('The function to make a command from must be a callable')
 
@@ -12,9 +12,11 @@ class Command:
             raise RuntimeError('The function to make a command from must be a coroutine')
 
         self.extension = extension
+        self.name = name or function.__name__
         self.signature = inspect.signature(function)
         self.parser: ArgumentParser = self.process_parameters(self.signature.parameters)
         self.function: callable = function
+        self.positional, self.var_positional, self.keyword = self.compile_binder(self.signature.parameters)
 
     def process_parameters(self, params: dict) -> ArgumentParser:
         iterator = iter(params.items())
@@ -53,7 +55,71 @@ class Command:
 
         return parser
 
+    def compile_binder(self, params: dict):
+        iterator = iter(params.values())
+        if self.extension:
+            next(iterator)
+        next(iterator)
+
+        positional = []
+        var_positional = None
+        keyword = []
+        for param in iterator:
+            param: inspect.Parameter
+            param_type = str if param.annotation == param.empty else param.annotation
+            if param.kind == param.POSITIONAL_OR_KEYWORD:
+                positional.append(param_type)
+            elif param.kind == param.VAR_POSITIONAL:
+                var_positional = param_type
+            elif param.kind == param.KEYWORD_ONLY:
+                default = None if param.default == param.empty else param.default
+                keyword.append((param.name, param_type, default))
+            else:
+                # Anything else is left to argparse
+                return None, None, None
+        return positional, var_positional, keyword
+
+    def bind(self, args_list: list):
+        # Handles plain positional arguments, anything argparse would treat differently returns None
+        if self.positional is None or any(arg[:1] == '-' for arg in args_list):
+            return None
+
+        fixed = len(self.positional)
+        if len(args_list) < fixed + (1 if self.var_positional else 0):
+            return None
+
+        try:
+            args = [param_type(arg) for param_type, arg in zip(self.positional, args_list)]
+            if self.var_positional:
+                args.extend(self.var_positional(arg) for arg in args_list[fixed:])
+                extra_params = []
+            else:
+                extra_params = args_list[fixed:]
+            kwargs = {
+                name: param_type(default) if isinstance(default, str) else default
+                for name, param_type, default in self.keyword
+            }
+        except (TypeError, ValueError, ArgumentTypeError):
+            # The same errors argparse reports as a usage error, it is left to produce it
+            return None
+        return args, kwargs, extra_params
+
     async def invoke(self, ctx, args_list):
+        if not args_list:
+            await self.function(ctx)
+            return
+
+        bound = self.bind(args_list)
+        if bound:
+            args, kwargs, ctx.extra_params = bound
+            await self.function(ctx, *args, **kwargs)
+            return
+
+        # argparse stays the reference parser and reports errors exactly as before
+        args, kwargs, ctx.extra_params = self.parse(args_list)
+        await self.function(ctx, *args, **kwargs)
+
+    def parse(self, args_list: list):
         iterator = iter(self.signature.parameters.items())
 
         if self.extension:
@@ -69,15 +135,12 @@ class Command:
 
         args = []
         kwargs = {}
-        if args_list:
-            params, ctx.extra_params = self.parser.parse_known_args(args_list)
-
-            for key, value in iterator:
-                value: inspect.Parameter
-                if value.kind == value.VAR_POSITIONAL or value.kind == value.POSITIONAL_OR_KEYWORD:
-                    args.extend(params.__dict__[key])
-                else:
-                    kwargs[key] = params.__dict__[key]
-            await self.function(ctx, *args, **kwargs)
-        else:
-            await self.function(ctx)
+        params, extra_params = self.parser.parse_known_args(args_list)
+
+        for key, value in iterator:
+            value: inspect.Parameter
+            if value.kind == value.VAR_POSITIONAL or value.kind == value.POSITIONAL_OR_KEYWORD:
+                args.extend(params.__dict__[key])
+            else:
+                kwargs[key] = params.__dict__[key]
+        return args, kwargs, extra_params
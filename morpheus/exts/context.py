@@ -2,6 +2,7 @@ from morpheus.core.client import Client
 from morpheus.core.room import Room
 from morpheus.core.events import RoomEvent
 from morpheus.core.content import ContentBase
+from morpheus.core.scheduler import PRIORITY_HIGH
 
 
 class Context:
@@ -17,7 +18,8 @@ class Context:
         self.extra_params: list = []
 
     async def send_text(self, body: str, formatted_body: str = None, format_type: str = 'org.matrix.custom.html'):
-        await self.client.send_text(self.room, body, formatted_body, format_type)
+        # Replies to commands are sent ahead of bulk traffic
+        await self.client.send_text(self.room, body, formatted_body, format_type, priority=PRIORITY_HIGH)
 
     @classmethod
     def get_context(cls, event: RoomEvent, calling_prefix: str, called_with: str, body: str):
@@ -0,0 +1,44 @@
+import re
+from typing import Optional, Dict, List, Tuple, Pattern
+
+
+class CommandRouter:
+    def __init__(self, max_patterns: int = 256):
+        self.names: List[str] = []
+        self.max_patterns = max_patterns
+        self._patterns: Dict[Tuple[str, ...], Pattern] = {}
+
+    def add(self, name: str):
+        self.names.append(name)
+        self._patterns.clear()
+
+    def remove(self, name: str):
+        self.names.remove(name)
+        self._patterns.clear()
+
+    def compile(self, prefixes: Tuple[str, ...]) -> Optional[Pattern]:
+        if not prefixes or not self.names:
+            return None
+        # Longest names first so the alternation settles on the most specific command
+        names = sorted(self.names, key=len, reverse=True)
+        return re.compile(
+            f"(?P<prefix>{'|'.join(map(re.escape, prefixes))})"
+            f"(?P<name>{'|'.join(map(re.escape, names))})"
+            f"(?: (?P<body>.*))?\\Z",
+            re.DOTALL,
+        )
+
+    def match(self, body: str, prefixes: Tuple[str, ...]) -> Optional[Tuple[str, str, Optional[str]]]:
+        pattern = self._patterns.get(prefixes)
+        if pattern is None:
+            pattern = self.compile(prefixes)
+            if pattern is None:
+                return None
+            # Callable prefixes may produce many combinations, keep the cache bounded
+            if len(self._patterns) >= self.max_patterns:
+                self._patterns.clear()
+            self._patterns[prefixes] = pattern
+        match = pattern.match(body)
+        if not match:
+            return None
+        return match.group("prefix"), match.group("name"), match.group("body")
@@ -0,0 +1,92 @@
+import asyncio
+from typing import Optional, Iterable
+
+from morpheus.core.cache import AliasCache
+from morpheus.core.codec import default_codec
+
+ROOM_ID = "!room:example.org"
+ALICE = "@alice:example.org"
+
+
+def make_event(
+    event_type: str = "m.room.message",
+    event_id: str = "$event",
+    content: Optional[dict] = None,
+    **fields,
+) -> dict:
+    # Fields passed as None are left out of the event
+    event = {
+        "type": event_type,
+        "event_id": event_id,
+        "sender": ALICE,
+        "origin_server_ts": 1000,
+        "unsigned": {"age": 1},
+        "content": {"msgtype": "m.text", "body": "hello"} if content is None else content,
+    }
+    event.update(fields)
+    return {key: value for key, value in event.items() if value is not None}
+
+
+def state_event(event_type: str, state_key: str, event_id: str, content: dict, **unsigned) -> dict:
+    return make_event(event_type, event_id, content, state_key=state_key, unsigned={"age": 1, **unsigned})
+
+
+def room_block(state: Iterable[dict] = (), timeline: Iterable[dict] = (), prev_batch: Optional[str] = None) -> dict:
+    block = {
+        "state": {"events": list(state)},
+        "ephemeral": {"events": []},
+        "timeline": {"events": list(timeline)},
+    }
+    if prev_batch:
+        block["timeline"]["prev_batch"] = prev_batch
+    return block
+
+
+def sync_response(
+    next_batch: str,
+    state: Iterable[dict] = (),
+    timeline: Iterable[dict] = (),
+    room_id: str = ROOM_ID,
+    prev_batch: Optional[str] = None,
+) -> dict:
+    return {
+        "next_batch": next_batch,
+        "rooms": {"join": {room_id: room_block(state, timeline, prev_batch)}, "invite": {}, "leave": {}},
+    }
+
+
+class FakeAPI:
+    # Stands in for API with only the parts the tests touch, requests are recorded instead of sent
+    def __init__(self, state: Optional[list] = None, hooks: Optional[list] = None):
+        self.state = state or []
+        self.hooks = hooks or []
+        self.alias_cache = AliasCache()
+        self.codec = default_codec()
+        self.requests = []
+        self.receipts = []
+        self.downloads = []
+        # Responses for get_sync in order, once they run out the request waits until it is cancelled
+        self.syncs: list = []
+        self.sync_since: list = []
+
+    def build_url(self, path: str, *args) -> str:
+        return path
+
+    async def send(self, method: str, path: str, *args, **kwargs):
+        self.requests.append((method, path))
+        return self.state
+
+    async def get_sync(self, sync_filter, since, full_state, set_presence, timeout):
+        self.sync_since.append(since)
+        if not self.syncs:
+            await asyncio.sleep(3600)
+        return self.syncs.pop(0)
+
+    async def send_receipt(self, room_id: str, event_id: str, receipt_type: str):
+        self.receipts.append(event_id)
+
+    async def download(self, mxc_uri: str, destination, width: int = None, height: int = None, method: str = "scale"):
+        self.downloads.append(mxc_uri)
+        data = mxc_uri.encode() * 4
+        destination.write(data)
+        return len(data)
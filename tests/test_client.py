@@ -0,0 +1,200 @@
+import asyncio
+import unittest
+from typing import Optional
+
+from morpheus.core.client import Client
+from morpheus.core.room import Room
+
+from .helpers import ROOM_ID, FakeAPI, make_event, sync_response
+
+
+def apply_filter(resp: dict, sync_filter: dict) -> dict:
+    # What the homeserver does with the uploaded filter
+    types = set(sync_filter["room"]["timeline"]["types"])
+    for data in resp["rooms"]["join"].values():
+        data["timeline"]["events"] = [event for event in data["timeline"]["events"] if event["type"] in types]
+    return resp
+
+
+class SyncFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("!")
+        self.client.register_handler("m.room.message", self.on_message)
+        self.client.mark_event_read = self.mark_event_read
+        self.receipts = []
+
+    async def on_message(self, event):
+        pass
+
+    async def mark_event_read(self, event, receipt_type: str = "m.read"):
+        self.receipts.append(event.event_id)
+
+    def test_timeline_includes_redactions_and_reactions(self):
+        types = self.client.build_sync_filter().to_dict()["room"]["timeline"]["types"]
+        self.assertIn("m.room.message", types)
+        self.assertIn("m.room.redaction", types)
+        self.assertIn("m.reaction", types)
+
+    def test_timeline_without_message_cache(self):
+        self.client.message_cache = None
+        types = self.client.build_sync_filter().to_dict()["room"]["timeline"]["types"]
+        self.assertNotIn("m.room.redaction", types)
+        self.assertNotIn("m.reaction", types)
+
+    def test_redaction_reaches_message_cache(self):
+        sync_filter = self.client.build_sync_filter().to_dict()
+        message = make_event("m.room.message", "$message")
+        reaction = make_event(
+            "m.reaction",
+            "$reaction",
+            {"m.relates_to": {"rel_type": "m.annotation", "event_id": "$message", "key": "+1"}},
+            origin_server_ts=1001,
+        )
+        redaction = make_event("m.room.redaction", "$redaction", {}, origin_server_ts=1002, redacts="$message")
+
+        async def run():
+            self.client.loop = asyncio.get_running_loop()
+            await self.client.process_sync(apply_filter(sync_response("s1", timeline=[message, reaction]), sync_filter))
+            cache = self.client.rooms[ROOM_ID].message_cache
+            self.assertEqual(cache["$message"].content.body, "hello")
+            self.assertEqual([event.event_id for event in cache.related("$message")], ["$reaction"])
+
+            await self.client.process_sync(apply_filter(sync_response("s2", timeline=[redaction]), sync_filter))
+            event = cache["$message"]
+            self.assertIsNone(getattr(event.content, "body", None))
+            self.assertEqual(event.unsigned.redacted_because.event_id, "$redaction")
+            self.assertEqual(self.client.sync_since, "s2")
+            self.assertEqual(self.receipts, ["$reaction", "$redaction"])
+            await self.client.dispatcher.close()
+
+        asyncio.run(run())
+
+
+class RecordingClient(Client):
+    def __init__(self, delay: float = 0.01):
+        super().__init__("!")
+        self.delay = delay
+        self.stop_after: Optional[str] = None
+        # next_batch of every processed batch and the checkpoint when its processing started
+        self.processed = []
+
+    async def process_sync(self, resp: dict):
+        self.processed.append((resp["next_batch"], self.sync_since))
+        await asyncio.sleep(self.delay)
+        await super().process_sync(resp)
+        if resp["next_batch"] == self.stop_after:
+            self.running = False
+
+
+class PipelinedSyncTest(unittest.TestCase):
+    def run_pipelined(self, client: RecordingClient, syncs: list):
+        async def run():
+            client.loop = asyncio.get_running_loop()
+            client.api = FakeAPI()
+            client.api.syncs = syncs
+            client.sync_pipeline_depth = 2
+            client.running = True
+            try:
+                await client.sync_pipelined()
+            finally:
+                await client.dispatcher.close()
+
+        asyncio.run(run())
+
+    def test_batches_are_processed_in_order_and_checkpointed_after(self):
+        client = RecordingClient()
+        client.stop_after = "s3"
+        syncs = [sync_response(f"s{n}", timeline=[make_event(event_id=f"${n}")]) for n in (1, 2, 3)]
+        self.run_pipelined(client, syncs)
+        # The checkpoint only moves once the previous batch has been processed
+        self.assertEqual(client.processed, [("s1", None), ("s2", "s1"), ("s3", "s2")])
+        self.assertEqual(client.sync_since, "s3")
+        self.assertEqual(client.api.sync_since[:3], [None, "s1", "s2"])
+        self.assertEqual(list(client.rooms[ROOM_ID].message_cache), ["$1", "$2", "$3"])
+
+    def test_fetch_error_while_processing_is_raised(self):
+        client = RecordingClient(delay=0.05)
+        with self.assertRaises(RuntimeError):
+            self.run_pipelined(client, [sync_response("s1"), {"errcode": "M_UNKNOWN_TOKEN"}])
+        self.assertEqual(client.sync_since, "s1")
+
+    def test_fetch_error_is_raised_after_a_stop(self):
+        client = RecordingClient(delay=0.05)
+        client.stop_after = "s1"
+        with self.assertRaises(RuntimeError):
+            self.run_pipelined(client, [sync_response("s1"), {"errcode": "M_UNKNOWN_TOKEN"}])
+
+    def test_stop_without_error(self):
+        client = RecordingClient()
+        client.stop_after = "s1"
+        self.run_pipelined(client, [sync_response("s1")])
+        self.assertEqual(client.sync_since, "s1")
+
+
+class SendAPI(FakeAPI):
+    def __init__(self, failing: tuple = ()):
+        super().__init__()
+        self.failing = failing
+        self.running = 0
+        self.max_running = 0
+        # room id and the body it was sent with
+        self.sent = []
+
+    async def room_send(self, room_id: str, event_type: str, content, priority: int = 0):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if room_id in self.failing:
+                raise RuntimeWarning(f"Could not send to {room_id}")
+            self.sent.append((room_id, content))
+            return {"event_id": f"${room_id}"}
+        finally:
+            self.running -= 1
+
+
+class SendBatchTest(unittest.TestCase):
+    def collect(self, results) -> list:
+        async def run():
+            return [result async for result in results]
+
+        return asyncio.run(run())
+
+    def test_send_many(self):
+        client = Client("!")
+        client.api = SendAPI(failing=("!room3:example.org",))
+        rooms = [f"!room{n}:example.org" for n in range(10)]
+        # Rooms can be given as Room objects or ids, results come back with what was given
+        rooms[0] = Room(rooms[0], client)
+        content = {"msgtype": "m.text", "body": "hello"}
+        results = self.collect(client.send_many(rooms, content, concurrency=3))
+
+        self.assertEqual(sorted(rooms[1:]), sorted(room for room, _ in results if isinstance(room, str)))
+        sent_to_room, = [result for room, result in results if room is rooms[0]]
+        self.assertEqual(sent_to_room, {"event_id": "$!room0:example.org"})
+        failed, = [(room, result) for room, result in results if isinstance(result, Exception)]
+        self.assertEqual(failed[0], "!room3:example.org")
+        self.assertIsInstance(failed[1], RuntimeWarning)
+        self.assertEqual(client.api.max_running, 3)
+        self.assertEqual(len(client.api.sent), 9)
+        # The same content object is encoded once and every room gets the same body
+        body, = {content for _, content in client.api.sent}
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(client.api.codec.loads(body), content)
+
+    def test_send_batch_encodes_each_content_once(self):
+        client = Client("!")
+        client.api = SendAPI()
+        first, second = {"body": "first"}, {"body": "second"}
+        messages = [("!a:example.org", first), ("!b:example.org", second), ("!c:example.org", first)]
+        results = self.collect(client.send_batch(messages, concurrency=1))
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(client.api.max_running, 1)
+        bodies = dict(client.api.sent)
+        self.assertIs(bodies["!a:example.org"], bodies["!c:example.org"])
+        self.assertEqual(client.api.codec.loads(bodies["!b:example.org"]), second)
+
+
+if __name__ == "__main__":
+    unittest.main()
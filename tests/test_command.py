@@ -0,0 +1,78 @@
+import argparse
+import contextlib
+import io
+import unittest
+
+from morpheus.exts.command import Command
+
+
+def even(value: str) -> int:
+    number = int(value)
+    if number % 2:
+        raise argparse.ArgumentTypeError(f"{value} is not even")
+    return number
+
+
+async def positional(ctx, a: int, b):
+    pass
+
+
+async def var_positional(ctx, first, *rest: int):
+    pass
+
+
+async def keyword_only(ctx, a, *, count: int = "5", name=None, label: str = "x"):
+    pass
+
+
+async def typed(ctx, number: even):
+    pass
+
+
+class BinderTest(unittest.TestCase):
+    def assertMatchesArgparse(self, command: Command, args_list: list):
+        bound = command.bind(args_list)
+        self.assertIsNotNone(bound, args_list)
+        self.assertEqual(bound, command.parse(args_list), args_list)
+
+    def assertArgparseError(self, command: Command, args_list: list):
+        self.assertIsNone(command.bind(args_list))
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            command.parse(args_list)
+
+    def test_positional(self):
+        command = Command(positional)
+        self.assertMatchesArgparse(command, ["1", "two"])
+        self.assertMatchesArgparse(command, ["1", "two", "three", "four"])
+        self.assertEqual(command.bind(["1", "two"]), ([1, "two"], {}, []))
+
+    def test_var_positional(self):
+        command = Command(var_positional)
+        self.assertMatchesArgparse(command, ["a", "1"])
+        self.assertMatchesArgparse(command, ["a", "1", "2", "3"])
+        self.assertEqual(command.bind(["a", "1", "2"]), (["a", 1, 2], {}, []))
+
+    def test_keyword_only_defaults(self):
+        command = Command(keyword_only)
+        self.assertMatchesArgparse(command, ["a"])
+        self.assertEqual(command.bind(["a"]), (["a"], {"count": 5, "name": None, "label": "x"}, []))
+
+    def test_missing_arguments(self):
+        self.assertArgparseError(Command(positional), ["1"])
+        self.assertArgparseError(Command(var_positional), ["a"])
+
+    def test_conversion_errors(self):
+        self.assertArgparseError(Command(positional), ["one", "two"])
+        self.assertArgparseError(Command(typed), ["3"])
+        self.assertMatchesArgparse(Command(typed), ["4"])
+
+    def test_dash_prefixed_values(self):
+        command = Command(keyword_only)
+        self.assertIsNone(command.bind(["a", "--count", "7"]))
+        self.assertEqual(command.parse(["a", "--count", "7"]), (["a"], {"count": [7], "name": None, "label": "x"}, []))
+        self.assertIsNone(Command(positional).bind(["-1", "two"]))
+        self.assertEqual(Command(positional).parse(["-1", "two"])[0], [-1, "two"])
+
+
+if __name__ == "__main__":
+    unittest.main()
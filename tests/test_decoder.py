@@ -0,0 +1,125 @@
+import unittest
+
+from morpheus.core.client import Client
+from morpheus.core.content import (
+    ContentBase,
+    LazyContent,
+    MTextContent,
+    MNoticeContent,
+    MRoomCreateContent,
+    MReactionContent,
+)
+from morpheus.core.decoder import EventDecoder
+from morpheus.core.events import MessageEvent, StateEvent, RedactionEvent, RoomEvent, PresenceEvent, EventBase
+
+from .helpers import make_event
+
+
+class EnvelopeTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("!")
+        self.decoder = EventDecoder()
+
+    def test_missing_envelope_fields_are_rejected(self):
+        for key in ("type", "event_id", "sender", "origin_server_ts"):
+            with self.subTest(key=key):
+                event = make_event()
+                del event[key]
+                with self.assertRaises(RuntimeWarning):
+                    self.decoder.decode(self.client, event)
+
+    def test_missing_optional_fields_default_to_none(self):
+        event = self.decoder.decode(self.client, make_event(unsigned={}, content={"msgtype": "m.text"}))
+        self.assertIsNone(event.unsigned.age)
+        self.assertIsNone(event.content.body)
+
+    def test_client_drops_malformed_events(self):
+        with self.assertLogs("morpheus.core.client", "WARNING"):
+            self.assertIsNone(self.client.decode_event(make_event(event_id=None)))
+        self.assertEqual(self.client.decode_event(make_event()).event_id, "$event")
+
+
+class EventDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("!")
+        self.decoder = EventDecoder()
+
+    def decode(self, event: dict, **kwargs):
+        return self.decoder.decode(self.client, event, **kwargs)
+
+    def test_event_and_content_classes(self):
+        event = self.decode(make_event())
+        self.assertIsInstance(event, MessageEvent)
+        self.assertIsInstance(event.content, MTextContent)
+        self.assertEqual(event.content.body, "hello")
+        self.assertEqual(event.unsigned.age, 1)
+
+        notice = self.decode(make_event(content={"msgtype": "m.notice", "body": "hi"}))
+        self.assertIsInstance(notice.content, MNoticeContent)
+
+        create = {"creator": "@alice:example.org", "m.federate": False}
+        state = self.decode(make_event("m.room.create", state_key="", content=create))
+        self.assertIsInstance(state, StateEvent)
+        self.assertIsInstance(state.content, MRoomCreateContent)
+        self.assertFalse(state.content.m_federate)
+
+        redaction = self.decode(make_event("m.room.redaction", redacts="$other", content={}))
+        self.assertIsInstance(redaction, RedactionEvent)
+        self.assertEqual(redaction.redacts, "$other")
+
+        other = self.decode(make_event("org.example.custom", content={"value": 1}))
+        self.assertIs(type(other), RoomEvent)
+        self.assertIs(type(other.content), ContentBase)
+        self.assertEqual(other.content.extra, {"value": 1})
+
+    def test_presence(self):
+        event = self.decode({"type": "m.presence", "sender": "@alice:example.org", "content": {"presence": "online"}})
+        self.assertIsInstance(event, PresenceEvent)
+        self.assertEqual(event.content.presence, "online")
+
+    def test_reaction(self):
+        event = self.decode(make_event(
+            type="m.reaction",
+            content={"m.relates_to": {"rel_type": "m.annotation", "event_id": "$target", "key": "+1"}},
+        ))
+        self.assertIsInstance(event.content, MReactionContent)
+        self.assertEqual(event.content.relation.event_id, "$target")
+        self.assertEqual(event.content.relation.key, "+1")
+
+    def test_reply(self):
+        event = self.decode(make_event(content={
+            "msgtype": "m.text",
+            "body": "reply",
+            "m.relates_to": {"m.in_reply_to": {"event_id": "$parent"}},
+        }))
+        self.assertEqual(event.content.relates_to.event_id, "$parent")
+
+    def test_unknown_keys_are_kept(self):
+        event = self.decode(make_event(room_id="!room:example.org", unsigned={"age": 1, "custom": True}))
+        self.assertEqual(event.extra, {"room_id": "!room:example.org"})
+        self.assertEqual(event.unsigned.extra, {"custom": True})
+
+    def test_lazy_content_matches_eager(self):
+        for event_dict in (make_event(), make_event("m.room.name", state_key="", content={"name": "room"})):
+            eager = self.decode(event_dict)
+            lazy = self.decode(event_dict, lazy=True)
+            self.assertIsInstance(lazy, type(eager))
+            self.assertIsInstance(EventBase.__dict__["content"].__get__(lazy), LazyContent)
+            self.assertEqual(lazy.content, eager.content)
+            self.assertNotIsInstance(lazy.content, LazyContent)
+
+    def test_eager_events_have_no_content_property(self):
+        event = self.decode(make_event())
+        self.assertNotIsInstance(type(event).content, property)
+        self.assertIsInstance(self.decode(make_event(), lazy=True).__class__.content, property)
+
+    def test_table_is_capped(self):
+        decoder = EventDecoder(max_entries=0)
+        for n in range(5):
+            decoder.decode(self.client, make_event(f"org.example.{n}"))
+        self.assertEqual(len(decoder.table), 0)
+        self.assertEqual(decoder.decode(self.client, make_event()).content.body, "hello")
+
+
+if __name__ == "__main__":
+    unittest.main()
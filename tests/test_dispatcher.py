@@ -0,0 +1,133 @@
+import asyncio
+import unittest
+
+from morpheus.core.client import Client
+from morpheus.core.dispatcher import HandlerDispatcher
+from morpheus.core.metrics import RequestHook
+
+from .helpers import ROOM_ID, FakeAPI, room_block, state_event
+
+
+class FakeRoom:
+    def __init__(self, room_id: str):
+        self.id = room_id
+
+
+class FakeEvent:
+    type = "m.room.message"
+
+    def __init__(self, room: FakeRoom, index: int):
+        self.room = room
+        self.index = index
+
+
+class HandlerDispatcherTest(unittest.TestCase):
+    def test_hot_room_does_not_starve_workers(self):
+        async def run():
+            client = Client("!")
+            client.loop = asyncio.get_running_loop()
+            dispatcher = HandlerDispatcher(client, workers=2, room_limit=1)
+            release = asyncio.Event()
+            seen = []
+
+            async def handler(event):
+                seen.append((event.room.id, event.index))
+                if event.room.id == "!hot":
+                    await release.wait()
+
+            hot, quiet = FakeRoom("!hot"), FakeRoom("!quiet")
+            for index in range(5):
+                await dispatcher.submit(handler, FakeEvent(hot, index))
+            await dispatcher.submit(handler, FakeEvent(quiet, 0))
+            for _ in range(10):
+                await asyncio.sleep(0)
+
+            # One hot room event runs, the rest wait without holding the second worker
+            self.assertEqual(seen, [("!hot", 0), ("!quiet", 0)])
+            self.assertEqual(dispatcher.waiting, 4)
+            self.assertFalse(await dispatcher.join(0.01))
+
+            release.set()
+            self.assertTrue(await dispatcher.join(1))
+            self.assertEqual([index for room_id, index in seen if room_id == "!hot"], [0, 1, 2, 3, 4])
+            self.assertEqual(dispatcher.processed, 6)
+            self.assertEqual(dispatcher.queue_depth, 0)
+            await dispatcher.close()
+
+        asyncio.run(run())
+
+    def test_handler_limit(self):
+        async def run():
+            client = Client("!")
+            client.loop = asyncio.get_running_loop()
+            dispatcher = HandlerDispatcher(client, workers=4, handler_limit=2)
+            running = 0
+            peak = 0
+
+            async def slow(event):
+                nonlocal running, peak
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+            fast_calls = []
+
+            async def fast(event):
+                fast_calls.append(event.index)
+
+            room = FakeRoom("!room")
+            for index in range(6):
+                await dispatcher.submit(slow, FakeEvent(room, index))
+            await dispatcher.submit(fast, FakeEvent(room, 0))
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertEqual(fast_calls, [0])
+            self.assertTrue(await dispatcher.join(1))
+            self.assertEqual(peak, 2)
+            self.assertEqual(dispatcher.processed, 7)
+            await dispatcher.close()
+
+        asyncio.run(run())
+
+
+class LagHook(RequestHook):
+    def __init__(self):
+        self.events = []
+
+    def on_dispatch(self, event, lag: float):
+        self.events.append(event.event_id)
+
+
+class SyncLagTest(unittest.TestCase):
+    def test_lag_recorded_once_per_timeline_event_at_handler_start(self):
+        async def run():
+            client = Client("!")
+            client.loop = asyncio.get_running_loop()
+            hook = LagHook()
+            client.api = FakeAPI(hooks=[hook])
+            started = []
+
+            async def first(event):
+                started.append((event.event_id, list(hook.events)))
+
+            async def second(event):
+                pass
+
+            client.register_handler("m.room.member", first)
+            client.register_handler("m.room.member", second)
+            alice = state_event("m.room.member", "@alice:example.org", "$state", {"membership": "join"})
+            bob = state_event("m.room.member", "@bob:example.org", "$timeline", {"membership": "join"})
+            await client.process_room_join(ROOM_ID, room_block(state=[alice], timeline=[bob]))
+            # Nothing is recorded while the events are only queued
+            self.assertEqual(hook.events, [])
+            self.assertTrue(await client.dispatcher.join(1))
+            await client.dispatcher.close()
+            self.assertEqual(hook.events, ["$timeline"])
+            self.assertEqual(dict(started)["$timeline"], ["$timeline"])
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
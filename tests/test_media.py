@@ -0,0 +1,82 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+
+from morpheus.core.client import Client
+from morpheus.core.media import MediaCache
+
+from .helpers import FakeAPI
+
+
+class MediaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_open_removes_partial_downloads(self):
+        key = MediaCache.cache_key("mxc://example.org/a")
+        os.makedirs(os.path.join(self.directory.name, key[:2]))
+        with open(os.path.join(self.directory.name, key[:2], key), "wb") as file:
+            file.write(b"12345")
+        partial = os.path.join(self.directory.name, key[:2], ".partial")
+        with open(partial, "wb") as file:
+            file.write(b"1")
+
+        cache = MediaCache(None, self.directory.name)
+        # Nothing touches the disk until the cache is opened
+        self.assertTrue(os.path.exists(partial))
+        asyncio.run(cache.open())
+        self.assertFalse(os.path.exists(partial))
+        self.assertIn("mxc://example.org/a", cache)
+        self.assertEqual(cache.size, 5)
+
+    def test_client_downloads_go_through_cache(self):
+        client = Client("!")
+        # Enabled before the client has an API
+        cache = client.enable_media_cache(self.directory.name)
+
+        async def run():
+            with self.assertRaises(RuntimeError):
+                await client.download("mxc://example.org/a", io.BytesIO())
+            client.api = cache.api = FakeAPI()
+
+            first, second = io.BytesIO(), io.BytesIO()
+            self.assertEqual(await client.download("mxc://example.org/a", first), 76)
+            self.assertEqual(await client.download("mxc://example.org/a", second), 76)
+            self.assertEqual(first.getvalue(), second.getvalue())
+            media = await client.get_media("mxc://example.org/a")
+            self.assertEqual(bytes(media[:]), first.getvalue())
+            media.close()
+            self.assertEqual(client.api.downloads, ["mxc://example.org/a"])
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        asyncio.run(run())
+
+    def test_concurrent_requests_share_one_download(self):
+        cache = MediaCache(FakeAPI(), self.directory.name)
+
+        async def run():
+            first = asyncio.ensure_future(cache.get_path("mxc://example.org/a"))
+            await asyncio.sleep(0)
+            # A caller that gives up does not cancel the download for the others
+            first.cancel()
+            paths = await asyncio.gather(*(cache.get_path("mxc://example.org/a") for _ in range(3)))
+            self.assertEqual(len(set(paths)), 1)
+            self.assertEqual(cache.api.downloads, ["mxc://example.org/a"])
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            self.assertEqual(await cache.get_path("mxc://example.org/a"), paths[0])
+            self.assertEqual(cache.hits, 1)
+
+        asyncio.run(run())
+
+    def test_client_without_cache(self):
+        client = Client("!")
+        client.api = FakeAPI()
+        media = asyncio.run(client.get_media("mxc://example.org/b"))
+        self.assertEqual(media, b"mxc://example.org/b" * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
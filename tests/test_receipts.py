@@ -0,0 +1,130 @@
+import asyncio
+import unittest
+
+from benchmarks.homeserver import FakeHomeserver
+from morpheus.core.client import Client
+from morpheus.core.room import Room
+
+from .helpers import ROOM_ID, make_event
+
+SENDER = "@user0:fake.local"
+
+
+class ReceiptCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("!")
+        self.client.user_id = "@bot:example.org"
+        self.client.mark_event_read = self.mark_event_read
+        self.room = Room(ROOM_ID, self.client)
+        self.coalescer = self.client.receipts
+        self.sent = []
+        self.failing = set()
+        # Called while a receipt is in flight, like an event arriving from a concurrent sync
+        self.on_send = None
+
+    async def mark_event_read(self, event, receipt_type: str = "m.read"):
+        self.sent.append(event.event_id)
+        if self.on_send:
+            self.on_send()
+        await asyncio.sleep(0)
+        if event.event_id in self.failing:
+            raise RuntimeWarning("Max retries reached")
+
+    def event(self, event_id: str, origin_server_ts: int, room: Room = None):
+        event_dict = make_event(event_id=event_id, origin_server_ts=origin_server_ts)
+        return self.client.process_event(event_dict, room or self.room)
+
+    def flush(self):
+        async def run():
+            self.client.loop = asyncio.get_running_loop()
+            await self.coalescer.flush()
+
+        asyncio.run(run())
+
+    def test_newest_event_per_room(self):
+        other = Room("!other:example.org", self.client)
+        self.coalescer.add(self.event("$2", 2000))
+        self.coalescer.add(self.event("$1", 1000))
+        self.coalescer.add(self.event("$3", 3000, other))
+        self.flush()
+        self.assertEqual(sorted(self.sent), ["$2", "$3"])
+        self.assertEqual(self.room.read_receipts[self.client.user_id], ("$2", 2000))
+        self.assertEqual(self.coalescer.pending, {})
+
+    def test_flush_interval(self):
+        async def run():
+            self.client.loop = asyncio.get_running_loop()
+            self.coalescer.flush_interval = 3600
+            self.assertFalse(self.coalescer.due())
+            self.coalescer.add(self.event("$1", 1000))
+            await self.coalescer.maybe_flush()
+            self.coalescer.add(self.event("$2", 2000))
+            # Held back until the interval has passed since the last flush
+            await self.coalescer.maybe_flush()
+            self.assertEqual(self.sent, ["$1"])
+            self.coalescer.flush_interval = None
+            await self.coalescer.maybe_flush()
+            self.assertEqual(self.sent, ["$1", "$2"])
+
+        asyncio.run(run())
+
+    def test_failed_receipt_is_sent_again(self):
+        self.failing.add("$1")
+        self.coalescer.add(self.event("$1", 1000))
+        with self.assertRaises(RuntimeWarning):
+            self.flush()
+        self.assertNotIn(self.client.user_id, self.room.read_receipts)
+        self.failing.clear()
+        self.flush()
+        self.assertEqual(self.sent, ["$1", "$1"])
+        self.assertEqual(self.room.read_receipts[self.client.user_id], ("$1", 1000))
+
+    def test_failed_receipt_does_not_replace_a_newer_event(self):
+        self.failing.add("$1")
+        self.coalescer.add(self.event("$1", 1000))
+        self.on_send = lambda: self.coalescer.add(self.event("$2", 2000))
+        with self.assertRaises(RuntimeWarning):
+            self.flush()
+        self.assertEqual(self.coalescer.pending[ROOM_ID].event_id, "$2")
+
+
+class ClientReceiptsTest(unittest.TestCase):
+    def test_pending_receipts_are_sent_when_the_client_stops(self):
+        server = FakeHomeserver()
+        server.create_room(ROOM_ID)
+        server.add_event(ROOM_ID, "m.room.message", {"msgtype": "m.text", "body": "hello"}, SENDER)
+
+        async def run():
+            client = Client("!", homeserver=await server.start())
+            client.loop = asyncio.get_running_loop()
+            client.sync_timeout = 100
+            client.receipts.flush_interval = 3600
+
+            async def on_message(event):
+                if event.content.body == "stop":
+                    client.running = False
+
+            client.register_handler("m.room.message", on_message)
+            task = asyncio.ensure_future(client.run("@bot:fake.local", password="password"))
+            try:
+                # The first flush is due right away, the receipt for stop is held back by the interval
+                for _ in range(500):
+                    if server.counts["receipts"]:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(server.counts["receipts"], 1)
+                stop = await server.inject(ROOM_ID, "m.room.message", {"msgtype": "m.text", "body": "stop"}, SENDER)
+                await asyncio.wait_for(task, 5)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await client.api.close()
+                await server.stop()
+            self.assertEqual(server.counts["receipts"], 2)
+            self.assertEqual(server.rooms[ROOM_ID].receipts["@bot:fake.local"], stop)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import unittest
+
+from aiohttp import web
+
+from benchmarks.homeserver import FakeHomeserver
+from morpheus.core.api import API
+from morpheus.core.client import Client
+from morpheus.core.room import Room
+
+from .helpers import ROOM_ID, ALICE, FakeAPI, state_event
+
+
+class AliasCacheTest(unittest.TestCase):
+    def apply_canonical_alias(self, room: Room, event_id: str, alias: str, alt_aliases: list):
+        event_dict = state_event("m.room.canonical_alias", "", event_id, {"alias": alias, "alt_aliases": alt_aliases})
+        room._apply_state(("m.room.canonical_alias", ""), room.client.process_event(event_dict, room))
+
+    def test_removed_alt_aliases_are_invalidated(self):
+        client = Client("!")
+        client.api = FakeAPI()
+        room = Room(ROOM_ID, client)
+        cache = client.api.alias_cache
+
+        self.apply_canonical_alias(room, "$1", "#main:example.org", ["#old:example.org", "#kept:example.org"])
+        self.assertEqual(cache.get("#old:example.org"), room.id)
+        self.assertEqual(room.alt_aliases, ["#old:example.org", "#kept:example.org"])
+
+        self.apply_canonical_alias(room, "$2", "#new:example.org", ["#kept:example.org"])
+        self.assertIsNone(cache.get("#old:example.org"))
+        self.assertIsNone(cache.get("#main:example.org"))
+        self.assertEqual(cache.get("#kept:example.org"), room.id)
+        self.assertEqual(cache.get("#new:example.org"), room.id)
+        self.assertEqual(room.alt_aliases, ["#kept:example.org"])
+
+
+class StuckHomeserver(FakeHomeserver):
+    # Answers every page with the token it was requested from as its end
+    async def messages(self, request: web.Request):
+        body = json.loads((await super().messages(request)).body)
+        body["end"] = request.query["from"]
+        return web.json_response(body)
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = self.make_server(FakeHomeserver)
+
+    @staticmethod
+    def make_server(server_class) -> FakeHomeserver:
+        server = server_class()
+        server.create_room(ROOM_ID)
+        for n in range(25):
+            server.add_event(ROOM_ID, "m.room.message", {"msgtype": "m.text", "body": str(n)}, ALICE)
+            if n == 12:
+                # Malformed, it is dropped instead of ending the history
+                del server.stream[-1][2]["event_id"]
+        return server
+
+    def paginate(self, consume) -> int:
+        # Returns the number of /messages requests
+        async def run():
+            token = f"t{self.server.position + 1}"
+            client = Client("!")
+            client.loop = asyncio.get_running_loop()
+            client.api = API(base_url=await self.server.start(), user_id=ALICE, password="password")
+            try:
+                await client.api.login()
+                requests = self.server.counts["requests"]
+                room = Room(ROOM_ID, client)
+                room.prev_batch = token
+                await consume(room)
+                return self.server.counts["requests"] - requests
+            finally:
+                await client.api.close()
+                await self.server.stop()
+
+        return asyncio.run(run())
+
+    def test_reads_every_page(self):
+        events = []
+
+        async def consume(room: Room):
+            requests = self.server.counts["requests"]
+            history = room.history(page_size=10)
+            events.append(await history.__anext__())
+            # The next page is on its way while the first one is still being read
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.server.counts["requests"] - requests, 2)
+            events.extend([event async for event in history])
+
+        self.assertEqual(self.paginate(consume), 5)
+        bodies = [event.content.body for event in events if event.type == "m.room.message"]
+        self.assertEqual(bodies, [str(n) for n in reversed(range(25)) if n != 12])
+        # The create, name, canonical alias and member events of the room come last
+        self.assertEqual(len(events), 24 + 8)
+        self.assertEqual(events[-1].type, "m.room.create")
+
+    def test_limit(self):
+        events = []
+
+        async def consume(room: Room):
+            events.extend([event async for event in room.history(limit=15, page_size=10)])
+
+        # The second page covers the limit, so nothing is read ahead after it
+        self.assertEqual(self.paginate(consume), 2)
+        self.assertEqual([event.content.body for event in events], [str(n) for n in range(24, 8, -1) if n != 12])
+
+    def test_stops_when_end_is_the_token(self):
+        self.server = self.make_server(StuckHomeserver)
+        events = []
+
+        async def consume(room: Room):
+            events.extend([event async for event in room.history(page_size=10)])
+
+        self.assertEqual(self.paginate(consume), 1)
+        self.assertEqual(len(events), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import asyncio
+import time
+import unittest
+
+from morpheus.core.scheduler import SendScheduler, TokenBucket, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = bucket.updated
+        for _ in range(2):
+            self.assertEqual(bucket.delay(now), 0.0)
+            bucket.consume(now)
+        self.assertAlmostEqual(bucket.delay(now), 0.1)
+        self.assertEqual(bucket.delay(now + 0.11), 0.0)
+
+    def test_disabled(self):
+        bucket = TokenBucket(rate=0, burst=1)
+        for _ in range(5):
+            bucket.consume(bucket.updated)
+            self.assertEqual(bucket.delay(bucket.updated), 0.0)
+
+
+class SendSchedulerTest(unittest.TestCase):
+    def test_priority_order(self):
+        async def run():
+            scheduler = SendScheduler(rate=50, burst=1)
+            # Takes the only token so everything after it has to queue
+            await scheduler.acquire()
+            order = []
+
+            async def send(name: str, priority: int):
+                await scheduler.acquire(priority=priority)
+                order.append(name)
+
+            tasks = [
+                asyncio.ensure_future(send("low", PRIORITY_LOW)),
+                asyncio.ensure_future(send("normal", PRIORITY_NORMAL)),
+                asyncio.ensure_future(send("high", PRIORITY_HIGH)),
+                asyncio.ensure_future(send("normal 2", PRIORITY_NORMAL)),
+            ]
+            await asyncio.wait_for(asyncio.gather(*tasks), 2)
+            return order
+
+        self.assertEqual(asyncio.run(run()), ["high", "normal", "normal 2", "low"])
+
+    def test_room_rate_does_not_hold_back_other_rooms(self):
+        async def run():
+            scheduler = SendScheduler(room_rate=5, room_burst=1)
+            await scheduler.acquire("!busy")
+            order = []
+
+            async def send(room_id: str):
+                await scheduler.acquire(room_id)
+                order.append(room_id)
+
+            await asyncio.wait_for(asyncio.gather(send("!busy"), send("!quiet")), 2)
+            return order
+
+        self.assertEqual(asyncio.run(run()), ["!quiet", "!busy"])
+
+    def test_backoff_pauses_every_request(self):
+        async def run():
+            scheduler = SendScheduler()
+            scheduler.backoff(100)
+            start = time.monotonic()
+            await asyncio.wait_for(asyncio.gather(scheduler.acquire(), scheduler.acquire("!room")), 2)
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.09)
+
+    def test_backoff_only_extends(self):
+        scheduler = SendScheduler()
+
+        async def run():
+            scheduler.backoff(1000)
+            resume_at = scheduler.resume_at
+            scheduler.backoff(10)
+            self.assertEqual(scheduler.resume_at, resume_at)
+            scheduler._pump.cancel()
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
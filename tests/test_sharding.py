@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+import unittest
+import zlib
+
+from morpheus.core.client import Client
+from morpheus.core.codec import default_codec
+from morpheus.core.sharding import _STOP, _worker, shard_for, split_sync
+from morpheus.core.store import MemoryStore
+
+from .helpers import ROOM_ID, ALICE, room_block, state_event, sync_response
+
+NAME = state_event("m.room.name", "", "$name", {"name": "before"})
+RENAME = state_event("m.room.name", "", "$rename", {"name": "after"}, replaces_state="$name")
+
+clients = []
+receipts = []
+
+
+async def mark_event_read(event, receipt_type: str = "m.read"):
+    receipts.append(event.event_id)
+
+
+def make_client() -> Client:
+    # Raises unless the worker calls the factory inside its event loop
+    asyncio.get_running_loop()
+    client = Client("!")
+    client.store = MemoryStore()
+    client.mark_event_read = mark_event_read
+    clients.append(client)
+    return client
+
+
+class SplitSyncTest(unittest.TestCase):
+    def test_shard_for_is_stable(self):
+        for room_id in (ROOM_ID, "!other:example.org", "!third:example.org"):
+            self.assertEqual(shard_for(room_id, 4), zlib.crc32(room_id.encode()) % 4)
+            self.assertIn(shard_for(room_id, 3), range(3))
+
+    def test_rooms_go_to_their_shard(self):
+        room_ids = [f"!room{n}:example.org" for n in range(8)]
+        resp = {
+            "next_batch": "s1",
+            "rooms": {
+                "join": {room_id: room_block() for room_id in room_ids[:4]},
+                "invite": {room_ids[4]: {}},
+                "leave": {room_id: room_block() for room_id in room_ids[5:]},
+            },
+            "presence": {"events": []},
+        }
+        slices = split_sync(resp, 3)
+        self.assertEqual(len(slices), 3)
+        seen = []
+        for index, shard_slice in enumerate(slices):
+            if shard_slice is None:
+                continue
+            self.assertEqual(shard_slice["next_batch"], "s1")
+            for membership, rooms in shard_slice["rooms"].items():
+                for room_id in rooms:
+                    self.assertEqual(shard_for(room_id, 3), index)
+                    self.assertIn(room_id, resp["rooms"][membership])
+                    seen.append(room_id)
+        self.assertEqual(sorted(seen), room_ids)
+        # Everything that isn't a room goes to the first shard
+        self.assertEqual(slices[0]["presence"], {"events": []})
+
+    def test_shards_without_rooms_are_skipped(self):
+        slices = split_sync(sync_response("s1"), 64)
+        self.assertEqual(sum(shard_slice is not None for shard_slice in slices), 1)
+
+
+class WorkerTest(unittest.TestCase):
+    def test_protocol(self):
+        codec = default_codec()
+        parent, child = multiprocessing.Pipe()
+        clients.clear()
+        receipts.clear()
+
+        def exchange(data: bytes) -> dict:
+            parent.send_bytes(data)
+            if not parent.poll(5):
+                raise RuntimeError("The worker did not acknowledge the batch")
+            return codec.loads(parent.recv_bytes())
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            worker = asyncio.ensure_future(
+                _worker(make_client, 0, "http://localhost", ALICE, "token", "DEVICE", None, child)
+            )
+            try:
+                # The stored state comes first, the event that replaces it does not look like a gap
+                await loop.run_in_executor(None, parent.send_bytes, codec.dumps({ROOM_ID: [NAME]}))
+                saved = await loop.run_in_executor(
+                    None, exchange, codec.dumps(sync_response("s1", timeline=[RENAME]))
+                )
+                self.assertEqual(saved, {"rooms": {ROOM_ID: [RENAME]}, "replace": []})
+                saved = await loop.run_in_executor(None, exchange, codec.dumps(sync_response("s2")))
+                self.assertEqual(saved, {"rooms": {}, "replace": []})
+            finally:
+                await loop.run_in_executor(None, parent.send_bytes, _STOP)
+                await asyncio.wait_for(worker, 5)
+
+        asyncio.run(run())
+        parent.close()
+        client, = clients
+        room = client.rooms[ROOM_ID]
+        self.assertEqual(room.name, "after")
+        self.assertEqual(room.state_gaps, 0)
+        self.assertEqual(client.sync_since, "s2")
+        self.assertFalse(client.running)
+        self.assertEqual(receipts, ["$rename"])
+        # The store belongs to the parent, the worker never writes to it
+        self.assertNotIsInstance(client.store, MemoryStore)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from morpheus.core.client import Client
+from morpheus.core.store import StoreBase, MemoryStore, SQLiteStore
+
+from .helpers import ROOM_ID, FakeAPI, state_event, sync_response
+
+ALICE = state_event("m.room.member", "@alice:example.org", "$alice", {"membership": "join"})
+BOB = state_event("m.room.member", "@bob:example.org", "$bob", {"membership": "join"})
+NAME = state_event("m.room.name", "", "$name", {"name": "before"})
+# The server missed the event that replaced $name, and bob left in the same gap
+RENAME = state_event("m.room.name", "", "$rename", {"name": "after"}, replaces_state="$missed")
+# Dropped from the fetched state, it never reaches the room or the store
+MALFORMED = state_event("m.room.topic", "", None, {"topic": "no event id"})
+AGAIN = state_event("m.room.name", "", "$again", {"name": "again"}, replaces_state="$rename")
+FINAL = state_event("m.room.name", "", "$final", {"name": "final"}, replaces_state="$again")
+
+
+class RefetchedStateTest(unittest.TestCase):
+    def sync_with_gap(self, store):
+        client = Client("!")
+        client.store = store
+        client.api = FakeAPI([ALICE, RENAME, MALFORMED])
+
+        async def run():
+            client.loop = asyncio.get_running_loop()
+            await store.open()
+            await client.process_sync(sync_response("s1", state=[ALICE, BOB, NAME]))
+            await client.process_sync(sync_response("s2", timeline=[RENAME]))
+            await store.flush()
+            loaded = await store.load()
+            await store.close()
+            return loaded
+
+        next_batch, rooms = asyncio.run(run())
+        room = client.rooms[ROOM_ID]
+        self.assertEqual(room.state_gaps, 1)
+        self.assertEqual(room.name, "after")
+        self.assertNotIn(("m.room.topic", ""), room.state)
+        self.assertEqual(set(room.members), {"@alice:example.org"})
+        self.assertEqual(next_batch, "s2")
+        self.assertEqual(sorted(event["event_id"] for event in rooms[ROOM_ID]), ["$alice", "$rename"])
+
+    def test_memory_store(self):
+        self.sync_with_gap(MemoryStore())
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.sync_with_gap(SQLiteStore(os.path.join(directory, "state.db")))
+
+    def test_one_fetch_per_batch(self):
+        # The state fetched for the gap at $rename already includes $again and $final
+        store = MemoryStore()
+        client = Client("!")
+        client.store = store
+        client.api = FakeAPI([ALICE, FINAL])
+
+        async def run():
+            client.loop = asyncio.get_running_loop()
+            await client.process_sync(sync_response("s1", state=[ALICE, BOB, NAME]))
+            await client.process_sync(sync_response("s2", timeline=[RENAME, AGAIN, FINAL]))
+            await store.flush()
+            return await store.load()
+
+        next_batch, rooms = asyncio.run(run())
+        room = client.rooms[ROOM_ID]
+        self.assertEqual(len(client.api.requests), 1)
+        self.assertEqual(room.state_gaps, 1)
+        self.assertEqual(room.name, "final")
+        self.assertEqual(sorted(event["event_id"] for event in rooms[ROOM_ID]), ["$alice", "$final"])
+
+
+class StoreBaseTest(unittest.TestCase):
+    def test_load_and_save_are_required(self):
+        class LoadOnly(StoreBase):
+            async def load(self):
+                return None, {}
+
+        with self.assertRaises(TypeError):
+            StoreBase()
+        with self.assertRaises(TypeError):
+            LoadOnly()
+        MemoryStore()
+
+
+if __name__ == "__main__":
+    unittest.main()